@@ -0,0 +1,191 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge
+
+from engine_client import AdapterNotFound
+
+load_dotenv()
+
+# Каталог с LoRA-адаптерами. Поддерживаются две раскладки:
+#   ADAPTER_DIR/adapter_config.json          -> адаптер с именем "default"
+#   ADAPTER_DIR/<имя>/adapter_config.json    -> адаптер с именем <имя>
+ADAPTER_DIR = os.getenv("ADAPTER_DIR", "./model/LoRA_outputs")
+# Сколько памяти (МБ) могут занимать одновременно загруженные адаптеры
+ADAPTER_CACHE_MAX_MB = int(os.getenv("ADAPTER_CACHE_MAX_MB", "1024"))
+
+DEFAULT_ADAPTER_NAME = "default"
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+ADAPTER_WEIGHT_FILES = ("adapter_model.safetensors", "adapter_model.bin")
+
+# Имя адаптера попадает в имена модулей PEFT, поэтому точки и прочие символы запрещены
+_NAME_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+logger = logging.getLogger("uii-llm-api")
+
+LLM_ADAPTER_LOADS_TOTAL = Counter("llm_adapter_loads_total", "Загрузки LoRA-адаптеров в кэш", ["adapter"])
+LLM_ADAPTER_EVICTIONS_TOTAL = Counter(
+    "llm_adapter_evictions_total",
+    "Выгрузки LoRA-адаптеров из кэша (reason=lru - нехватка памяти, reason=stale - вышла новая версия)",
+    ["reason"],
+)
+LLM_ADAPTER_CACHE_BYTES = Gauge("llm_adapter_cache_bytes", "Память, занятая загруженными LoRA-адаптерами")
+LLM_ADAPTER_CACHE_SIZE = Gauge("llm_adapter_cache_size", "Количество загруженных LoRA-адаптеров")
+
+
+@dataclass
+class AdapterVersion:
+    name: str
+    path: str
+    # Отпечаток файлов адаптера (mtime): меняется, когда на диск кладут новую версию
+    version: str
+
+    @property
+    def key(self) -> str:
+        """Имя адаптера внутри PEFT-модели: разные версии не пересекаются."""
+        return f"{self.name}__{self.version}"
+
+
+@dataclass
+class LoadedAdapter:
+    name: str
+    version: str
+    key: str
+    size_bytes: int
+
+
+class AdapterManager:
+    """
+    LRU-кэш LoRA-адаптеров поверх одной базовой модели.
+
+    Адаптеры подгружаются с диска при первом запросе и живут в общей PEFT-модели,
+    так что в одном батче можно смешивать строки с разными адаптерами
+    (peft mixed-batch, adapter_names=[...]). Когда суммарный размер адаптеров
+    превышает max_bytes, выгружаются давно не использованные.
+
+    Новая версия адаптера определяется по mtime файлов: при следующем запросе
+    старая версия выгружается, новая загружается - без перезапуска сервиса.
+    Чтобы не поймать наполовину скопированный адаптер, выкладывайте новую
+    версию во временный каталог и переименовывайте его целиком.
+
+    acquire() меняет модель и должен вызываться только из потока планировщика,
+    между вызовами generate().
+    """
+
+    def __init__(self, root: str = ADAPTER_DIR, max_bytes: int = ADAPTER_CACHE_MAX_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.base_model = None
+        # Модель для генерации: базовая, а после первой загрузки адаптера - PeftModel
+        self.model = None
+        # LRU: имя адаптера -> LoadedAdapter (последний элемент - самый свежий)
+        self._loaded: "OrderedDict[str, LoadedAdapter]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def attach(self, base_model) -> None:
+        with self._lock:
+            self.base_model = base_model
+            self.model = base_model
+            self._loaded.clear()
+            self._update_gauges()
+
+    def discover(self) -> Dict[str, str]:
+        """Адаптеры, лежащие на диске: имя -> путь."""
+        found: Dict[str, str] = {}
+        if not os.path.isdir(self.root):
+            return found
+        if os.path.isfile(os.path.join(self.root, ADAPTER_CONFIG_FILE)):
+            found[DEFAULT_ADAPTER_NAME] = self.root
+        for entry in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, entry)
+            if _NAME_RE.match(entry) and os.path.isfile(os.path.join(path, ADAPTER_CONFIG_FILE)):
+                found[entry] = path
+        return found
+
+    def resolve(self, name: str) -> AdapterVersion:
+        if not _NAME_RE.match(name or ""):
+            raise AdapterNotFound(f"invalid adapter name: {name!r}")
+        if name == DEFAULT_ADAPTER_NAME and os.path.isfile(os.path.join(self.root, ADAPTER_CONFIG_FILE)):
+            path = self.root
+        else:
+            path = os.path.join(self.root, name)
+        files = [os.path.join(path, f) for f in (ADAPTER_CONFIG_FILE,) + ADAPTER_WEIGHT_FILES]
+        mtimes = [os.stat(f).st_mtime_ns for f in files if os.path.isfile(f)]
+        if not os.path.isfile(files[0]) or len(mtimes) < 2:
+            raise AdapterNotFound(f"adapter {name!r} not found in {self.root}")
+        return AdapterVersion(name=name, path=path, version=format(max(mtimes), "x"))
+
+    def acquire(self, name: str, pinned: Iterable[str] = ()) -> str:
+        """
+        Гарантирует, что актуальная версия адаптера загружена, и возвращает
+        её имя внутри PEFT-модели. Адаптеры из pinned (ключи) не выгружаются.
+        """
+        target = self.resolve(name)
+        with self._lock:
+            current = self._loaded.get(name)
+            if current is not None and current.version == target.version:
+                self._loaded.move_to_end(name)
+                # Кэш мог остаться сверх бюджета после батча, в котором все адаптеры были заняты
+                self._evict(pinned=set(pinned) | {current.key})
+                return current.key
+            if current is not None:
+                logger.warning("ADAPTER: new version of %r detected (%s -> %s)", name, current.version, target.version)
+                self._unload(name, reason="stale")
+            self._load(target)
+            self._evict(pinned=set(pinned) | {target.key})
+            return target.key
+
+    def loaded(self) -> List[dict]:
+        with self._lock:
+            return [adapter.__dict__.copy() for adapter in self._loaded.values()]
+
+    def total_bytes(self) -> int:
+        return sum(adapter.size_bytes for adapter in self._loaded.values())
+
+    def _load(self, target: AdapterVersion) -> None:
+        from peft import PeftModel
+
+        if self.base_model is None:
+            raise RuntimeError("base model is not attached")
+        logger.warning("ADAPTER: loading %r from %s", target.key, target.path)
+        if self.model is self.base_model:
+            self.model = PeftModel.from_pretrained(self.base_model, target.path, adapter_name=target.key)
+        else:
+            self.model.load_adapter(target.path, adapter_name=target.key)
+        self.model.eval()
+
+        marker = f".{target.key}."
+        size = sum(p.numel() * p.element_size() for n, p in self.model.named_parameters() if marker in n)
+        self._loaded[target.name] = LoadedAdapter(
+            name=target.name, version=target.version, key=target.key, size_bytes=size,
+        )
+        LLM_ADAPTER_LOADS_TOTAL.labels(adapter=target.name).inc()
+        self._update_gauges()
+
+    def _unload(self, name: str, reason: str) -> None:
+        adapter = self._loaded.pop(name)
+        logger.warning("ADAPTER: unloading %r (%s)", adapter.key, reason)
+        self.model.delete_adapter(adapter.key)
+        LLM_ADAPTER_EVICTIONS_TOTAL.labels(reason=reason).inc()
+        self._update_gauges()
+
+    def _evict(self, pinned: set) -> None:
+        while self.total_bytes() > self.max_bytes:
+            victim = next((a.name for a in self._loaded.values() if a.key not in pinned), None)
+            if victim is None:
+                logger.warning(
+                    "ADAPTER: cache over budget (%d > %d bytes), all adapters are in use",
+                    self.total_bytes(), self.max_bytes,
+                )
+                return
+            self._unload(victim, reason="lru")
+
+    def _update_gauges(self) -> None:
+        LLM_ADAPTER_CACHE_BYTES.set(self.total_bytes())
+        LLM_ADAPTER_CACHE_SIZE.set(len(self._loaded))
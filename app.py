@@ -1,16 +1,28 @@
 import os
+import hmac
+import math
+import base64
 import time
 import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import List, Literal, Optional
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from prometheus_client import Counter, Histogram
 from prometheus_fastapi_instrumentator import Instrumentator
 
-from model import load_model_and_tokenizer, generate_answer
-from system_checks import check_nvidia_smi, check_torch_cuda, check_bitsandbytes, summarize_checks_host, summarize_checks_docker
+# Только лёгкие модули: с ENGINE_SOCKET воркер не импортирует torch, модель и метрики движка
+from prompts import get_prompt_template
+from engine_client import (
+    AdapterNotFound, EngineClient, EngineUnavailable, GenerationInput, Overloaded,
+    ENGINE_SOCKET, SHUTDOWN_DRAIN_TIMEOUT_S,
+)
+from scheduler import DeadlineExceeded
+from retrieval import Retriever, compose_system_prompt, engine_embedder
 
 load_dotenv()
 
@@ -26,11 +38,20 @@ logger = logging.getLogger("uii-llm-api")
 
 # -----------------------
 # System prompt (as provided)
+# Справочные данные (тарифы, курсы и т.п.) не вшиваются сюда целиком:
+# под каждый вопрос подбираются фрагменты из KNOWLEDGE_DIR (см. retrieval.py)
 # -----------------------
 SYSTEM_PROMPT = ( )
 
 DEFAULT_MAX_NEW_TOKENS = int(os.getenv("DEFAULT_MAX_NEW_TOKENS", "180"))
 DEFAULT_TEMPERATURE = float(os.getenv("DEFAULT_TEMPERATURE", "0.7"))
+# Дедлайн ответа по умолчанию (мс) для запросов без deadline_ms; 0 - без дедлайна
+DEFAULT_DEADLINE_MS = int(os.getenv("DEFAULT_DEADLINE_MS", "0"))
+# Токен для /admin/* (заголовок X-Admin-Token); пустой - админ-эндпоинты выключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# /embed: сколько текстов в одном запросе и до скольки токенов обрезается каждый текст
+EMBED_MAX_TEXTS = int(os.getenv("EMBED_MAX_TEXTS", "256"))
+EMBED_MAX_TOKENS = int(os.getenv("EMBED_MAX_TOKENS", "512"))
 
 # -----------------------
 # FastAPI init
@@ -49,90 +70,365 @@ LLM_GENERATION_LATENCY = Histogram(
     "Время генерации ответа LLM",
     buckets=(0.2,0.5,1,2,3,5,8,13,21,34),
 )
+LLM_DEADLINE_MISSES_TOTAL = Counter(
+    "llm_deadline_misses_total",
+    "Запросы, не уложившиеся в дедлайн (stage=queue - отброшен в очереди, stage=decode - ответ обрезан)",
+    ["stage"],
+)
 
 Instrumentator().instrument(app).expose(app, include_in_schema=False)
 
 # -----------------------
-# Load model once at startup
+# Model engine: в этом процессе или отдельный процесс движка (serve.py)
 # -----------------------
-logger.warning("STARTUP: проверки CUDA/NVIDIA окружения (nvidia-smi, torch.cuda, bitsandbytes)")
-smi = check_nvidia_smi()
-if smi.ok:
-    logger.warning("CHECK OK: %s", smi.message)
-else:
-    logger.error("CHECK FAIL: %s | %s", smi.message, smi.details or "")
-
-cuda = check_torch_cuda()
-if cuda.ok:
-    logger.warning("CHECK OK: %s", cuda.message)
+if ENGINE_SOCKET:
+    # Несколько HTTP-воркеров, модель одна - в процессе движка (engine.py), связь через Unix-сокет
+    logger.warning("STARTUP: подключение к процессу движка %s", ENGINE_SOCKET)
+    ENGINE = EngineClient(ENGINE_SOCKET)
 else:
-    logger.error("CHECK FAIL: %s | %s", cuda.message, cuda.details or "")
+    # Модель загружается один раз прямо в этом процессе (uvicorn с одним воркером)
+    from engine import InferenceEngine
 
-bnb = check_bitsandbytes()
-if bnb.ok:
-    logger.warning("CHECK OK: %s", bnb.message)
-else:
-    logger.error("CHECK FAIL: %s | %s", bnb.message, bnb.details or "")
+    ENGINE = InferenceEngine(SYSTEM_PROMPT)
+ENGINE.start()
+SHUTTING_DOWN = False
 
-logger.warning("STARTUP: загрузка базовой модели (один раз)")
+# Индекс базы знаний: в промпт попадают только фрагменты, относящиеся к вопросу.
+# Модель эмбеддингов (RETRIEVAL_EMBED_MODEL) работает в движке, а не в каждом воркере
+RETRIEVER = Retriever(embed_fn=engine_embedder(ENGINE))
 try:
-    MODEL, TOKENIZER = load_model_and_tokenizer(logger=logger)
-    logger.warning("STARTUP: модель успешно загружена, сервис готов")
+    RETRIEVER.reindex()
 except Exception as e:
-    logger.error("STARTUP ERROR: модель не загрузилась: %s", str(e))
-    MODEL, TOKENIZER = None, None
+    logger.error("STARTUP ERROR: индекс базы знаний не собран: %s", str(e))
+# Индекс пересобрали в другом HTTP-воркере - перечитываем (из кэша на диске) и здесь
+ENGINE.subscribe("reindex", lambda _: threading.Thread(target=RETRIEVER.reindex, daemon=True).start())
+
+
+def _wait(future: Future, deadline: Optional[float]):
+    """
+    Ждёт результат движка, но не дольше дедлайна. Если к дедлайну запрос всё ещё
+    стоит в очереди (за чужим батчем), он снимается - DeadlineExceeded, 504.
+    Уже идущую генерацию ждём дальше: она сама остановится по дедлайну
+    и вернёт частичный ответ (stop_reason=truncated).
+    """
+    if deadline is None:
+        return future.result()
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0.0))
+    except FutureTimeout:
+        if not future.cancel():
+            return future.result()
+    raise DeadlineExceeded("deadline expired while waiting in queue")
 
 
 class GenerateRequest(BaseModel):
     prompt: str
     max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS
     temperature: float = DEFAULT_TEMPERATURE
+    # Бюджет на ответ в миллисекундах (от момента получения запроса), > 0.
+    # Если не задан - используется DEFAULT_DEADLINE_MS.
+    deadline_ms: Optional[int] = Field(default=None, gt=0)
+    # Имя LoRA-адаптера из ADAPTER_DIR; None - базовая модель
+    adapter: Optional[str] = None
 
 
 class GenerateResponse(BaseModel):
     result: str
+    # stop | length | truncated (ответ обрезан по дедлайну)
+    stop_reason: str = "stop"
+    # Файлы базы знаний, фрагменты из которых попали в промпт
+    sources: List[str] = []
+    # Упрощения под нагрузкой: cap_tokens (урезан max_new_tokens), greedy (без сэмплирования),
+    # cached (готовый ответ из кэша)
+    degradations: List[str] = []
 
 
 @app.post("/generate", response_model=GenerateResponse)
 def generate(req: GenerateRequest) -> GenerateResponse:
-    if MODEL is None or TOKENIZER is None:
+    if not ENGINE.accepting():
         raise HTTPException(status_code=503, detail="Model is not initialized. Check service logs.")
 
     LLM_REQUESTS_TOTAL.inc()
     t0 = time.time()
+    started = time.monotonic()
+
+    deadline_ms = req.deadline_ms if req.deadline_ms is not None else DEFAULT_DEADLINE_MS
+    deadline = started + deadline_ms / 1000.0 if deadline_ms > 0 else None
+
+    logger.warning("POST /generate prompt_prefix=%r max_new_tokens=%s temperature=%s deadline_ms=%s adapter=%s",
+                   req.prompt[:80], req.max_new_tokens, req.temperature, deadline_ms or None, req.adapter)
 
-    logger.warning("POST /generate prompt_prefix=%r max_new_tokens=%s temperature=%s",
-                   req.prompt[:80], req.max_new_tokens, req.temperature)
+    passages = _retrieve(req.prompt)
+    item = GenerationInput(
+        question=req.prompt,
+        max_new_tokens=req.max_new_tokens,
+        temperature=req.temperature,
+        deadline=deadline,
+        adapter=req.adapter,
+        system_prompt=compose_system_prompt(SYSTEM_PROMPT, passages),
+    )
 
     try:
         with LLM_GENERATION_LATENCY.time():
-            answer = generate_answer(
-                question=req.prompt,
-                model=MODEL,
-                tokenizer=TOKENIZER,
-                system_prompt=SYSTEM_PROMPT,
-                max_new_tokens=req.max_new_tokens,
-                temperature=req.temperature,
-            )
-        logger.warning("OK /generate elapsed=%.3fs", time.time() - t0)
-        return GenerateResponse(result=answer)
+            completion = _wait(ENGINE.generate(item), deadline)
+    except AdapterNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Overloaded as e:
+        logger.error("OVERLOADED /generate elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(
+            status_code=429, detail=str(e), headers={"Retry-After": str(int(math.ceil(e.retry_after)))},
+        )
+    except EngineUnavailable as e:
+        logger.error("UNAVAILABLE /generate elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(status_code=503, detail=str(e))
+    except DeadlineExceeded as e:
+        LLM_DEADLINE_MISSES_TOTAL.labels(stage="queue").inc()
+        logger.error("DEADLINE /generate elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(status_code=504, detail=f"Deadline exceeded: {str(e)}")
     except Exception as e:
         logger.error("ERROR /generate elapsed=%.3fs err=%s", time.time() - t0, str(e))
         raise HTTPException(status_code=500, detail=f"Generation error: {str(e)}")
 
+    if completion.stop_reason == "truncated":
+        LLM_DEADLINE_MISSES_TOTAL.labels(stage="decode").inc()
+    logger.warning("OK /generate elapsed=%.3fs stop_reason=%s degradations=%s",
+                   time.time() - t0, completion.stop_reason, ",".join(completion.degradations) or "-")
+    return GenerateResponse(
+        result=completion.text,
+        stop_reason=completion.stop_reason,
+        sources=sorted({p.source for p in passages}),
+        degradations=completion.degradations,
+    )
+
+
+class TokenizeRequest(BaseModel):
+    texts: List[str]
+
+
+class TokenizeResponse(BaseModel):
+    input_ids: List[List[int]]
+    counts: List[int]
+
+
+class CountTokensResponse(BaseModel):
+    # Токены самого текста
+    counts: List[int]
+    # Токены полного промпта, если отправить текст в /generate (с системным промптом и разметкой)
+    prompt_tokens: List[int]
+
+
+def _tokenizer():
+    tokenizer = ENGINE.tokenizer()
+    if tokenizer is None:
+        raise HTTPException(status_code=503, detail="Tokenizer is not initialized. Check service logs.")
+    return tokenizer
+
+
+def _tokenize_texts(texts: List[str]) -> List[List[int]]:
+    return get_prompt_template(_tokenizer()).encode_texts(texts)
+
+
+def _retrieve(question: str) -> list:
+    """Фрагменты базы знаний под вопрос (бюджет считается токенайзером модели)."""
+    if not RETRIEVER.enabled:
+        return []
+    return RETRIEVER.retrieve(question, count_tokens=lambda texts: [len(ids) for ids in _tokenize_texts(texts)])
+
+
+@app.post("/tokenize", response_model=TokenizeResponse)
+def tokenize(req: TokenizeRequest) -> TokenizeResponse:
+    """Пакетная токенизация текстов тем же токенайзером, что и в /generate."""
+    input_ids = _tokenize_texts(req.texts)
+    return TokenizeResponse(input_ids=input_ids, counts=[len(ids) for ids in input_ids])
+
+
+@app.post("/count_tokens", response_model=CountTokensResponse)
+def count_tokens(req: TokenizeRequest) -> CountTokensResponse:
+    """Подсчёт токенов до вызова /generate - чтобы клиент мог уложиться в бюджет."""
+    template = get_prompt_template(_tokenizer())
+    counts = [len(ids) for ids in template.encode_texts(req.texts)]
+    # Системный промпт зависит от найденных под вопрос фрагментов базы знаний
+    overheads = [
+        template.overhead(compose_system_prompt(SYSTEM_PROMPT, _retrieve(text))) for text in req.texts
+    ]
+    return CountTokensResponse(counts=counts, prompt_tokens=[o + n for o, n in zip(overheads, counts)])
+
+
+class EmbedRequest(BaseModel):
+    texts: List[str] = Field(min_length=1, max_length=EMBED_MAX_TEXTS)
+    # mean - среднее скрытых состояний по токенам текста, last - состояние последнего токена
+    pooling: Literal["mean", "last"] = "mean"
+    # Нормировать векторы (L2): косинусная близость сводится к скалярному произведению
+    normalize: bool = True
+    # float - списки чисел; base64 - все векторы подряд как float32 little-endian (форма - count x dim)
+    encoding: Literal["float", "base64"] = "float"
+    # Как в /generate; не задан - DEFAULT_DEADLINE_MS
+    deadline_ms: Optional[int] = Field(default=None, gt=0)
+
+
+class EmbedResponse(BaseModel):
+    count: int
+    dim: int
+    embeddings: Optional[List[List[float]]] = None
+    embeddings_base64: Optional[str] = None
+    # Токены каждого текста, попавшие в модель (после обрезки до EMBED_MAX_TOKENS)
+    token_counts: List[int]
+    # Сколько текстов обрезано
+    truncated: int = 0
+
+
+@app.post("/embed", response_model=EmbedResponse)
+def embed(req: EmbedRequest) -> EmbedResponse:
+    """
+    Эмбеддинги текстов загруженной базовой моделью (для поиска и дедупликации):
+    forward-проход без декодирования, тексты близкой длины считаются батчами.
+    Идёт через ту же очередь, что и /generate, не вытесняя генерацию.
+    """
+    if not ENGINE.accepting():
+        raise HTTPException(status_code=503, detail="Model is not initialized. Check service logs.")
+
+    t0 = time.time()
+    deadline_ms = req.deadline_ms if req.deadline_ms is not None else DEFAULT_DEADLINE_MS
+    deadline = time.monotonic() + deadline_ms / 1000.0 if deadline_ms > 0 else None
+    token_ids = _tokenize_texts(req.texts)
+    truncated = sum(1 for ids in token_ids if len(ids) > EMBED_MAX_TOKENS)
+    token_ids = [ids[:EMBED_MAX_TOKENS] for ids in token_ids]
+
+    try:
+        result = _wait(ENGINE.embed(token_ids, pooling=req.pooling, normalize=req.normalize, deadline=deadline), deadline)
+    except Overloaded as e:
+        logger.error("OVERLOADED /embed elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(
+            status_code=429, detail=str(e), headers={"Retry-After": str(int(math.ceil(e.retry_after)))},
+        )
+    except EngineUnavailable as e:
+        logger.error("UNAVAILABLE /embed elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(status_code=503, detail=str(e))
+    except DeadlineExceeded as e:
+        LLM_DEADLINE_MISSES_TOTAL.labels(stage="queue").inc()
+        logger.error("DEADLINE /embed elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(status_code=504, detail=f"Deadline exceeded: {str(e)}")
+    except Exception as e:
+        logger.error("ERROR /embed elapsed=%.3fs err=%s", time.time() - t0, str(e))
+        raise HTTPException(status_code=500, detail=f"Embedding error: {str(e)}")
+
+    vectors = result.vectors
+    logger.warning("OK /embed elapsed=%.3fs texts=%d tokens=%d truncated=%d",
+                   time.time() - t0, len(req.texts), sum(result.token_counts), truncated)
+    response = EmbedResponse(
+        count=vectors.shape[0], dim=vectors.shape[1], token_counts=result.token_counts, truncated=truncated,
+    )
+    if req.encoding == "base64":
+        response.embeddings_base64 = base64.b64encode(vectors.astype("<f4").tobytes()).decode("ascii")
+    else:
+        response.embeddings = vectors.tolist()
+    return response
+
+
+@app.get("/adapters")
+def adapters():
+    """Список LoRA-адаптеров: доступные на диске и загруженные в кэш."""
+    try:
+        return ENGINE.adapters()
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+class ReloadRequest(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    # Имя/путь новой модели; по умолчанию - текущая (перечитать обновлённый чекпойнт)
+    model_name: Optional[str] = None
+    # parallel | drain; по умолчанию RELOAD_STRATEGY
+    strategy: Optional[str] = None
+
+
+def _check_admin(token: Optional[str]) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled: set ADMIN_TOKEN")
+    if not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+@app.post("/admin/reload", status_code=202)
+def admin_reload(req: ReloadRequest, x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Перезагрузка модели без остановки сервиса: новая модель грузится и прогревается
+    в фоне, затем новые батчи переключаются на неё. Статус - GET /admin/reload.
+    """
+    _check_admin(x_admin_token)
+    if SHUTTING_DOWN:
+        raise HTTPException(status_code=503, detail="Service is shutting down")
+    try:
+        started = ENGINE.start_reload(model_name=req.model_name, strategy=req.strategy)
+    except ValueError as e:
+        # Неизвестная strategy (список - serving.RELOAD_STRATEGIES)
+        raise HTTPException(status_code=400, detail=str(e))
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if not started:
+        raise HTTPException(status_code=409, detail="Reload is already in progress")
+    return ENGINE.reload_status()
+
+
+@app.get("/admin/reload")
+def admin_reload_status(x_admin_token: Optional[str] = Header(default=None)):
+    _check_admin(x_admin_token)
+    try:
+        return ENGINE.reload_status()
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.post("/admin/retrieval/reindex")
+def admin_retrieval_reindex(x_admin_token: Optional[str] = Header(default=None)):
+    """Пересобрать индекс базы знаний после изменения файлов в KNOWLEDGE_DIR."""
+    _check_admin(x_admin_token)
+    index = RETRIEVER.reindex()
+    # Остальные HTTP-воркеры подхватят новый индекс из кэша на диске
+    ENGINE.broadcast("reindex")
+    if index is None:
+        return {"enabled": False}
+    return {"enabled": True, "backend": index.backend, "passages": len(index.passages)}
+
+
+@app.get("/ready")
+def ready():
+    """Readiness для балансировщика: 503, пока модели нет или сервис останавливается."""
+    info = None if SHUTTING_DOWN else ENGINE.ready_info()
+    if info is None:
+        raise HTTPException(status_code=503, detail="Not ready")
+    return {"ready": True, **info}
+
+
+@app.on_event("shutdown")
+def drain_on_shutdown():
+    """
+    SIGTERM: uvicorn перестаёт принимать соединения и ждёт текущие запросы
+    (не дольше --timeout-graceful-shutdown), затем мы дожидаемся очереди генераций.
+    С отдельным процессом движка очередь дожидается сам движок (serve.py
+    останавливает его после HTTP-воркеров), а воркер только закрывает соединение.
+    """
+    global SHUTTING_DOWN
+    SHUTTING_DOWN = True
+    ENGINE.shutdown(timeout=SHUTDOWN_DRAIN_TIMEOUT_S)
+
 
 @app.get("/health")
 def health():
     """
     Health endpoint for monitoring.
-    Возвращает JSON с проверками окружения.
+    Возвращает JSON с проверками окружения процесса, который работает с GPU (движка).
     Определяет контейнер через переменную окружения DOCKER_ENV или через наличие /.dockerenv файла.
 
     Это удобно в учебной практике: студент сразу видит, что именно не готово.
     """
     # Проверяем наличие переменной окружения или файла /.dockerenv
     is_docker = os.getenv("DOCKER_ENV", "").lower() == "true" or os.path.isfile("/.dockerenv")
-    return summarize_checks_docker() if is_docker else summarize_checks_host()
+    try:
+        return ENGINE.health(docker=is_docker)
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
 # -----------------------
 # Minimal HTML + JS UI
@@ -0,0 +1,569 @@
+import os
+import time
+import signal
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import replace
+from multiprocessing.connection import Listener
+from queue import Queue
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from prometheus_client import Counter, Histogram, start_http_server
+
+from engine_client import (
+    ENGINE_SOCKET, SHUTDOWN_DRAIN_TIMEOUT_S, EmbeddingResult, EngineUnavailable, GenerationInput, Overloaded,
+)
+from model import EMBED_POOLING, GENERATION_STATE, embed_texts, generate_batch, length_buckets
+from overload import LEVELS, LLM_DEGRADATIONS_TOTAL, OverloadPolicy, ResponseCache
+from scheduler import GenerationScheduler
+from serving import ModelReloader, load_serving_model, warmup_serving_model
+from telemetry import ResourceSampler
+from system_checks import (
+    check_nvidia_smi, check_torch_cuda, check_bitsandbytes, summarize_checks_docker, summarize_checks_host,
+)
+
+load_dotenv()
+
+# Порт /metrics процесса движка (очередь, батчи, GPU, адаптеры); 0 - не поднимать
+ENGINE_METRICS_PORT = int(os.getenv("ENGINE_METRICS_PORT", "8001"))
+
+logger = logging.getLogger("uii-llm-api")
+
+LLM_QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds",
+    "Время ожидания запроса в очереди до начала генерации",
+    buckets=(0.01,0.05,0.1,0.2,0.5,1,2,3,5,8,13),
+)
+LLM_BATCH_SIZE = Histogram(
+    "llm_batch_size",
+    "Количество запросов в одном вызове model.generate()",
+    buckets=(1,2,3,4,6,8,12,16),
+)
+LLM_EMBED_TOKENS_TOTAL = Counter("llm_embed_tokens_total", "Токены текстов, прошедших через /embed")
+
+
+def _log_system_checks() -> None:
+    logger.warning("STARTUP: проверки CUDA/NVIDIA окружения (nvidia-smi, torch.cuda, bitsandbytes)")
+    for check in (check_nvidia_smi, check_torch_cuda, check_bitsandbytes):
+        result = check()
+        if result.ok:
+            logger.warning("CHECK OK: %s", result.message)
+        else:
+            logger.error("CHECK FAIL: %s | %s", result.message, result.details or "")
+
+
+def _load_retrieval_encoder(model_name: str) -> Callable[[List[str]], np.ndarray]:
+    try:
+        from sentence_transformers import SentenceTransformer
+    except Exception:
+        raise RuntimeError("sentence-transformers is not installed")
+    encoder = SentenceTransformer(model_name)
+    return lambda texts: encoder.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+class InferenceEngine:
+    """
+    Всё, что работает с GPU: модель, очередь генераций, перезагрузка модели, телеметрия.
+
+    Живёт либо в процессе FastAPI (ENGINE_SOCKET пуст), либо в отдельном процессе
+    движка, к которому HTTP-воркеры ходят через EngineClient с тем же набором методов.
+    """
+
+    def __init__(self, system_prompt: str = ""):
+        # Системный промпт для прогрева; запросы приносят свой (GenerationInput.system_prompt)
+        self.system_prompt = system_prompt
+        self.scheduler = GenerationScheduler(on_wait=LLM_QUEUE_WAIT.observe)
+        self.reloader = ModelReloader(self.scheduler, system_prompt=system_prompt, on_finish=self._state_changed)
+        self.sampler = ResourceSampler(generation_state=GENERATION_STATE)
+        # Деградация под нагрузкой и кэш ответов для неё
+        self.policy = OverloadPolicy()
+        self.response_cache = ResponseCache()
+        self.shutting_down = False
+        # Энкодер поиска по базе знаний (RETRIEVAL_EMBED_MODEL): один на сервис, в процессе движка.
+        # Свой поток, а не очередь генераций: эмбеддинг вопроса не ждёт чужие батчи
+        self._retrieval_encoders: Dict[str, Callable[[List[str]], np.ndarray]] = {}
+        self._retrieval_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="retrieval-encoder")
+        # Колбэк на смену состояния (модель загружена/перезагружена, остановка) - для EngineServer
+        self.on_state_change: Optional[Callable[[dict], None]] = None
+
+    def start(self) -> None:
+        _log_system_checks()
+        logger.warning("STARTUP: загрузка базовой модели (один раз)")
+        try:
+            # Модель, токенайзер, LoRA-адаптеры и (опционально) статический KV-кэш одним объектом,
+            # чтобы при перезагрузке модели их можно было подменить разом
+            serving = load_serving_model(logger=logger)
+            # Прогрев (в режиме статического KV-кэша - ещё и torch.compile), чтобы он не лёг на первые запросы
+            warmup_serving_model(serving, self.system_prompt)
+            self.reloader.current = serving
+            logger.warning("STARTUP: модель успешно загружена, сервис готов")
+        except Exception as e:
+            logger.error("STARTUP ERROR: модель не загрузилась: %s", str(e))
+        # Все генерации идут через одну очередь: GPU одна, совместимые запросы батчируются
+        self.scheduler.start()
+        # Память GPU/KV-кэша (или RSS/CPU без GPU) опрашивается в фоне, а не на каждый scrape
+        self.sampler.start()
+        self._state_changed()
+
+    def state(self) -> dict:
+        current = self.reloader.current
+        return {
+            "accepting": self.accepting(),
+            "model": current.name if current is not None and current.ready else None,
+        }
+
+    def _state_changed(self) -> None:
+        if self.on_state_change is not None:
+            self.on_state_change(self.state())
+
+    def accepting(self) -> bool:
+        return not self.shutting_down and self.reloader.accepting()
+
+    def tokenizer(self):
+        current = self.reloader.current
+        return current.tokenizer if current is not None else None
+
+    def generate(self, item: GenerationInput) -> Future:
+        """
+        Ставит вопрос в очередь; запросы с одинаковой temperature батчируются.
+
+        Под нагрузкой запрос упрощается по ступеням OverloadPolicy: урезается
+        max_new_tokens, выключается сэмплирование, ответ берётся из кэша, а на
+        последней ступени запрос отклоняется (Overloaded). Применённые упрощения -
+        в GenerationResult.degradations.
+        """
+        if not self.accepting():
+            raise EngineUnavailable("Model is not initialized. Check service logs.")
+        if item.adapter is not None:
+            # AdapterNotFound - сразу, до очереди
+            self.reloader.current.adapters.resolve(item.adapter)
+
+        decision = self.policy.decide(queue_depth=self.scheduler.depth())
+        cache_key = self.response_cache.key(item.question, item.system_prompt, item.adapter)
+        degradations = []
+        if decision.level >= LEVELS.index("cache_only"):
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                LLM_DEGRADATIONS_TOTAL.labels(action="cached").inc()
+                future: Future = Future()
+                future.set_result(replace(cached, degradations=["cached"]))
+                return future
+        if decision.level >= LEVELS.index("reject"):
+            LLM_DEGRADATIONS_TOTAL.labels(action="rejected").inc()
+            raise Overloaded(
+                f"service is overloaded (estimated wait {decision.estimated_wait:.1f}s), retry later",
+                retry_after=self.policy.retry_after(decision),
+            )
+        if decision.level >= LEVELS.index("cap_tokens") and item.max_new_tokens > self.policy.cap_tokens:
+            item = replace(item, max_new_tokens=self.policy.cap_tokens)
+            degradations.append("cap_tokens")
+        if decision.level >= LEVELS.index("greedy") and item.temperature > 0:
+            item = replace(item, temperature=0.0)
+            degradations.append("greedy")
+        for action in degradations:
+            LLM_DEGRADATIONS_TOTAL.labels(action=action).inc()
+
+        self.policy.admit(item.max_new_tokens)
+        # Возвращается Future самой задачи планировщика: cancel() снимает запрос,
+        # пока он ждёт в очереди, и не срабатывает, когда генерация уже идёт.
+        # cost - чтобы запрос с дедлайном не попал в батч с ответом, который его переживёт
+        future = self.scheduler.submit_batch_item(
+            (item, degradations, cache_key), batch_fn=self._generate_batch, batch_key=item.temperature,
+            deadline=item.deadline, cost=self.policy.decode_seconds(item.max_new_tokens),
+        )
+        # Токены отпускаются, чем бы ни кончился запрос: ответ, ошибка, дедлайн в очереди, отмена
+        future.add_done_callback(lambda f: self.policy.release(item.max_new_tokens))
+        return future
+
+    def _generate_batch(self, requests: list) -> list:
+        """
+        Выполняется в потоке планировщика: подгружает адаптеры и генерирует батч.
+        requests - (GenerationInput, применённые упрощения, ключ кэша ответов).
+        Модель берётся в момент старта батча - после перезагрузки это уже новая модель.
+        """
+        serving = self.reloader.current
+        if serving is None or not serving.ready:
+            raise RuntimeError("model is not loaded")
+        items = [item for item, _, _ in requests]
+        LLM_BATCH_SIZE.observe(len(items))
+        keys, errors = {}, {}
+        for name in {i.adapter for i in items if i.adapter}:
+            try:
+                keys[name] = serving.adapters.acquire(name, pinned=keys.values())
+            except Exception as e:
+                errors[name] = e
+
+        runnable = [i for i in items if i.adapter not in errors]
+        started = time.monotonic()
+        completions = generate_batch(
+            [replace(i, adapter=keys.get(i.adapter)) for i in runnable],
+            model=serving.adapters.model,
+            tokenizer=serving.tokenizer,
+            system_prompt=self.system_prompt,
+            static_cache=serving.static_decode,
+            kv_quant=serving.kv_quant,
+        ) if runnable else []
+        # Скорость генерации для оценки ожидания в очереди (OverloadPolicy) и длительности запросов
+        self.policy.observe_batch(
+            sum(c.completion_tokens for c in completions),
+            time.monotonic() - started,
+            steps=max((c.completion_tokens for c in completions), default=0),
+        )
+        results = iter(completions)
+        replies = []
+        for item, degradations, cache_key in requests:
+            if item.adapter in errors:
+                replies.append(errors[item.adapter])
+                continue
+            result = next(results)
+            if result.stop_reason == "stop":
+                self.response_cache.put(cache_key, result)
+            replies.append(replace(result, degradations=degradations) if degradations else result)
+        return replies
+
+    def embed(
+        self,
+        token_ids: List[List[int]],
+        pooling: str = "mean",
+        normalize: bool = True,
+        deadline: Optional[float] = None,
+    ) -> Future:
+        """
+        Эмбеддинги текстов (токены без служебных, см. model.embed_batch) базовой моделью.
+
+        Тексты режутся на группы близкой длины (length_buckets), и в очередь генераций
+        группы ставятся по одной: следующая - только когда посчитана предыдущая.
+        Так большой запрос на эмбеддинги занимает в очереди одно место и чередуется
+        с /generate, а не забирает GPU целиком. Группы разных запросов с одинаковыми
+        pooling/normalize считаются вместе. Эмбеддинги - фоновая работа, поэтому
+        отклоняются (Overloaded) раньше генерации - уже на ступени cache_only.
+        cancel() возвращённого Future снимает ещё не посчитанные группы.
+        """
+        if not self.accepting():
+            raise EngineUnavailable("Model is not initialized. Check service logs.")
+        if pooling not in EMBED_POOLING:
+            raise ValueError(f"unknown pooling {pooling!r}, expected one of {EMBED_POOLING}")
+        decision = self.policy.decide(queue_depth=self.scheduler.depth())
+        if decision.level >= LEVELS.index("cache_only"):
+            raise Overloaded(
+                f"service is overloaded (estimated wait {decision.estimated_wait:.1f}s), embeddings are paused",
+                retry_after=self.policy.retry_after(decision, level="cache_only"),
+            )
+
+        outer: Future = Future()
+        if not token_ids:
+            outer.set_result(EmbeddingResult(vectors=np.zeros((0, 0), dtype=np.float32), token_counts=[]))
+            return outer
+        # Модель здесь не трогаем: при перезагрузке (drain) её сейчас может не быть,
+        # группы дождутся новой в очереди. Размерность берётся из результатов
+        buckets = length_buckets([len(ids) for ids in token_ids])
+        parts: List[Any] = [None] * len(buckets)
+        # Задача планировщика для текущей группы - её снимает отмена запроса
+        current: List[Optional[Future]] = [None]
+
+        def finish() -> None:
+            try:
+                stacked = np.concatenate(parts)
+            except ValueError as e:
+                # Модель перезагрузили посреди запроса, и у новой другой hidden_size
+                outer.set_exception(e)
+                return
+            vectors = np.empty_like(stacked)
+            vectors[np.concatenate(buckets)] = stacked
+            outer.set_result(EmbeddingResult(vectors=vectors, token_counts=[len(ids) for ids in token_ids]))
+
+        def submit(n: int) -> None:
+            inner = self.scheduler.submit_batch_item(
+                ([token_ids[i] for i in buckets[n]], pooling, normalize),
+                batch_fn=self._embed_batch, batch_key=("embed", pooling, normalize), deadline=deadline,
+            )
+            current[0] = inner
+
+            def done(f: Future) -> None:
+                if outer.cancelled():
+                    return
+                error = f.exception()
+                if error is not None:
+                    if outer.set_running_or_notify_cancel():
+                        outer.set_exception(error)
+                    return
+                parts[n] = f.result()
+                if n + 1 < len(buckets):
+                    submit(n + 1)
+                elif outer.set_running_or_notify_cancel():
+                    finish()
+
+            inner.add_done_callback(done)
+
+        outer.add_done_callback(lambda f: f.cancelled() and current[0].cancel())
+        submit(0)
+        return outer
+
+    def _embed_batch(self, chunks: list) -> list:
+        """Выполняется в потоке планировщика: группы текстов нескольких запросов одним проходом."""
+        serving = self.reloader.current
+        if serving is None or not serving.ready:
+            raise EngineUnavailable("Model is not initialized. Check service logs.")
+        _, pooling, normalize = chunks[0]
+        token_ids = [ids for chunk_ids, _, _ in chunks for ids in chunk_ids]
+        LLM_EMBED_TOKENS_TOTAL.inc(sum(len(ids) for ids in token_ids))
+        result = embed_texts(
+            token_ids, serving.adapters.model, serving.tokenizer, pooling=pooling, normalize=normalize,
+        )
+        results, start = [], 0
+        for chunk_ids, _, _ in chunks:
+            results.append(result.vectors[start:start + len(chunk_ids)])
+            start += len(chunk_ids)
+        return results
+
+    def adapters(self) -> dict:
+        """LoRA-адаптеры: доступные на диске и загруженные в кэш."""
+        if self.reloader.current is None:
+            raise EngineUnavailable("Model is not initialized. Check service logs.")
+        manager = self.reloader.current.adapters
+        return {
+            "available": sorted(manager.discover()),
+            "loaded": manager.loaded(),
+            "cache_bytes": manager.total_bytes(),
+            "cache_max_bytes": manager.max_bytes,
+        }
+
+    def start_reload(self, model_name: Optional[str] = None, strategy: Optional[str] = None) -> bool:
+        """False - перезагрузка уже идёт."""
+        if self.shutting_down:
+            raise EngineUnavailable("Service is shutting down")
+        started = self.reloader.start(model_name=model_name, strategy=strategy)
+        if started:
+            self._state_changed()
+        return started
+
+    def reload_status(self) -> dict:
+        return self.reloader.status()
+
+    def ready_info(self) -> Optional[dict]:
+        """Данные для /ready; None - не готов принимать запросы."""
+        if not self.accepting():
+            return None
+        return {"model": self.reloader.current.name, "queue_depth": self.scheduler.depth()}
+
+    def health(self, docker: bool = False) -> dict:
+        """Проверки окружения для /health - того процесса, который работает с GPU."""
+        return summarize_checks_docker() if docker else summarize_checks_host()
+
+    def retrieval_embed(self, texts: List[str], model_name: str) -> Future:
+        """
+        Нормированные эмбеддинги фрагментов базы знаний и вопросов моделью
+        sentence-transformers model_name (см. retrieval.py). Модель грузится при первом вызове.
+        """
+        return self._retrieval_pool.submit(self._retrieval_embed, list(texts), model_name)
+
+    def _retrieval_embed(self, texts: List[str], model_name: str) -> np.ndarray:
+        encoder = self._retrieval_encoders.get(model_name)
+        if encoder is None:
+            logger.warning("RETRIEVAL: загрузка модели эмбеддингов %s", model_name)
+            encoder = self._retrieval_encoders[model_name] = _load_retrieval_encoder(model_name)
+        return encoder(texts)
+
+    def broadcast(self, event: str, payload: Any = None) -> None:
+        """Оповестить остальные HTTP-воркеры; в однопроцессном режиме их нет."""
+
+    def subscribe(self, event: str, fn: Callable[[Any], None]) -> None:
+        """События от других HTTP-воркеров; в однопроцессном режиме их нет."""
+
+    def shutdown(self, timeout: float = SHUTDOWN_DRAIN_TIMEOUT_S) -> bool:
+        """Перестаёт принимать запросы и ждёт обработки очереди генераций."""
+        self.shutting_down = True
+        self._state_changed()
+        logger.warning("SHUTDOWN: draining queue (depth=%d, timeout=%.0fs)", self.scheduler.depth(), timeout)
+        if self.scheduler.drain(timeout=timeout):
+            logger.warning("SHUTDOWN: queue drained")
+            return True
+        logger.error("SHUTDOWN: drain timeout, %d requests left in queue", self.scheduler.depth())
+        return False
+
+
+# -----------------------
+# IPC: процесс движка <-> HTTP-воркеры (протокол и клиент - engine_client.py)
+# -----------------------
+
+# Методы InferenceEngine, которые можно вызвать через сокет
+REMOTE_METHODS = (
+    "generate", "embed", "adapters", "start_reload", "reload_status", "ready_info", "health", "retrieval_embed",
+)
+
+
+class _Peer:
+    """Соединение с одним HTTP-воркером. Отправка - через очередь в отдельном потоке,
+    чтобы поток планировщика не ждал медленного читателя."""
+
+    def __init__(self, conn, on_close: Callable[["_Peer"], None]):
+        self.conn = conn
+        self.on_close = on_close
+        # Незавершённые запросы воркера: request_id -> Future движка (для "cancel")
+        self.futures: Dict[int, Future] = {}
+        self._outbox: "Queue[Optional[tuple]]" = Queue()
+        threading.Thread(target=self._writer, name="engine-peer-writer", daemon=True).start()
+
+    def send(self, message: tuple) -> None:
+        self._outbox.put(message)
+
+    def close(self) -> None:
+        self._outbox.put(None)
+
+    def _writer(self) -> None:
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                break
+            try:
+                self.conn.send(message)
+                continue
+            except (OSError, EOFError):
+                break
+            except Exception as e:
+                # Исключение (или результат), которое не сериализуется pickle
+                logger.error("ENGINE: reply is not picklable: %s", str(e))
+            request_id, _, value = message
+            try:
+                self.conn.send((request_id, False, RuntimeError(f"{type(value).__name__}: {value}")))
+            except (OSError, EOFError):
+                break
+        self.on_close(self)
+
+
+class EngineServer:
+    """Принимает подключения HTTP-воркеров к InferenceEngine по Unix-сокету."""
+
+    def __init__(self, engine: InferenceEngine, address: str = ENGINE_SOCKET):
+        self.engine = engine
+        self.address = address
+        self._peers: List[_Peer] = []
+        self._lock = threading.Lock()
+        self._listener: Optional[Listener] = None
+        engine.on_state_change = lambda state: self.broadcast("state", state)
+
+    def listen(self) -> None:
+        if os.path.exists(self.address):
+            # Сокет от предыдущего (упавшего) запуска
+            os.unlink(self.address)
+        self._listener = Listener(self.address, family="AF_UNIX")
+        # Доступ к движку - только у процессов того же пользователя
+        os.chmod(self.address, 0o600)
+        logger.warning("ENGINE: listening on %s", self.address)
+
+    def serve_forever(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                # Сокет закрыт в close()
+                return
+            peer = _Peer(conn, on_close=self._drop)
+            with self._lock:
+                self._peers.append(peer)
+            peer.send((None, "state", self.engine.state()))
+            threading.Thread(target=self._reader, args=(peer,), name="engine-peer-reader", daemon=True).start()
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+        with self._lock:
+            for peer in self._peers:
+                peer.close()
+
+    def broadcast(self, event: str, payload: Any = None) -> None:
+        with self._lock:
+            peers = list(self._peers)
+        for peer in peers:
+            peer.send((None, event, payload))
+
+    def _drop(self, peer: _Peer) -> None:
+        with self._lock:
+            if peer in self._peers:
+                self._peers.remove(peer)
+        try:
+            peer.conn.close()
+        except OSError:
+            pass
+
+    def _reader(self, peer: _Peer) -> None:
+        while True:
+            try:
+                request_id, method, kwargs = peer.conn.recv()
+            except (OSError, EOFError):
+                peer.close()
+                return
+            self._dispatch(peer, request_id, method, kwargs)
+
+    def _dispatch(self, peer: _Peer, request_id: int, method: str, kwargs: dict) -> None:
+        if method == "broadcast":
+            self.broadcast(**kwargs)
+            peer.send((request_id, True, None))
+            return
+        if method == "cancel":
+            future = peer.futures.get(kwargs["request_id"])
+            peer.send((request_id, True, future is not None and future.cancel()))
+            return
+        if method not in REMOTE_METHODS:
+            peer.send((request_id, False, AttributeError(f"unknown engine method {method!r}")))
+            return
+        try:
+            result = getattr(self.engine, method)(**kwargs)
+        except Exception as e:
+            peer.send((request_id, False, e))
+            return
+        if not isinstance(result, Future):
+            peer.send((request_id, True, result))
+            return
+
+        def reply(future: Future) -> None:
+            peer.futures.pop(request_id, None)
+            if future.cancelled():
+                # Отменил сам воркер - он уже не ждёт ответа
+                return
+            error = future.exception()
+            peer.send((request_id, False, error) if error is not None else (request_id, True, future.result()))
+
+        peer.futures[request_id] = result
+        result.add_done_callback(reply)
+
+
+def main() -> None:
+    """Процесс движка: python engine.py (обычно запускается из serve.py)."""
+    log_level = os.getenv("LOG_LEVEL", "WARNING").upper()
+    logging.basicConfig(
+        level=getattr(logging, log_level, logging.WARNING),
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    if not ENGINE_SOCKET:
+        raise SystemExit("ENGINE_SOCKET is not set")
+
+    engine = InferenceEngine()
+    server = EngineServer(engine, ENGINE_SOCKET)
+    # Сокет открывается до загрузки модели: воркеры подключаются сразу и до готовности отвечают 503
+    server.listen()
+    if ENGINE_METRICS_PORT:
+        start_http_server(ENGINE_METRICS_PORT)
+
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    threading.Thread(target=server.serve_forever, name="engine-server", daemon=True).start()
+    engine.start()
+
+    stop.wait()
+    engine.shutdown()
+    server.close()
+    if os.path.exists(ENGINE_SOCKET):
+        os.unlink(ENGINE_SOCKET)
+
+
+if __name__ == "__main__":
+    main()
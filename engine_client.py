@@ -0,0 +1,286 @@
+"""
+Всё, что нужно HTTP-воркеру для работы с процессом движка: EngineClient,
+данные запросов и ответов и исключения, которые движок передаёт через сокет (pickle).
+
+Модуль не импортирует torch, модель и метрики движка: его импортирует каждый
+HTTP-воркер, а распакованное исключение тянет за собой модуль своего класса.
+"""
+import os
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from dataclasses import dataclass, field
+from multiprocessing.connection import Client
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from prompts import load_tokenizer
+
+load_dotenv()
+
+# Unix-сокет процесса движка. Пусто - модель грузится прямо в процессе FastAPI
+# (один uvicorn-воркер); задан - HTTP-воркеры обращаются к движку через сокет (см. serve.py)
+ENGINE_SOCKET = os.getenv("ENGINE_SOCKET", "")
+# Таймаут служебных вызовов движка из HTTP-воркера (всё, кроме генерации), сек
+ENGINE_CALL_TIMEOUT_S = float(os.getenv("ENGINE_CALL_TIMEOUT_S", "30"))
+# Сколько ждать обработки очереди при остановке сервиса (SIGTERM), сек
+SHUTDOWN_DRAIN_TIMEOUT_S = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT_S", "60"))
+
+logger = logging.getLogger("uii-llm-api")
+
+
+@dataclass
+class GenerationInput:
+    question: str
+    max_new_tokens: int = 180
+    # <= 0 - жадное декодирование
+    temperature: float = 0.7
+    # Абсолютный дедлайн в шкале time.monotonic(); None - без ограничения
+    deadline: Optional[float] = None
+    # Имя PEFT-адаптера, уже загруженного в модель; None - базовая модель
+    adapter: Optional[str] = None
+    # Свой системный промпт (например, с найденными фрагментами базы знаний);
+    # None - общий system_prompt батча
+    system_prompt: Optional[str] = None
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    # "stop" - модель сама закончила ответ (eos / <|eot_id|>)
+    # "length" - упёрлись в max_new_tokens
+    # "truncated" - декодирование остановлено по дедлайну, текст частичный
+    stop_reason: str
+    prompt_tokens: int
+    completion_tokens: int
+    # Что было упрощено под нагрузкой: cap_tokens, greedy, cached (см. overload.py)
+    degradations: List[str] = field(default_factory=list)
+
+
+@dataclass
+class EmbeddingResult:
+    # float32, форма (количество текстов, hidden_size)
+    vectors: np.ndarray
+    # Сколько токенов текста попало в модель (без служебного префикса)
+    token_counts: List[int]
+
+
+class EngineUnavailable(Exception):
+    """Модель не загружена, сервис останавливается или процесс движка недоступен."""
+
+
+class AdapterNotFound(Exception):
+    """Адаптер с таким именем не найден в ADAPTER_DIR."""
+
+
+class Overloaded(Exception):
+    """Сервис перегружен, запрос отклонён; retry_after - через сколько секунд повторить."""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        # Оба аргумента в args - исключение переживает pickle (передачу из процесса движка)
+        super().__init__(message, retry_after)
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
+# -----------------------
+# IPC: процесс движка <-> HTTP-воркеры
+#
+# Одно соединение (Unix-сокет, multiprocessing.connection) на HTTP-воркер,
+# по нему мультиплексируются все запросы воркера:
+#   воркер -> движок: (request_id, method, kwargs)
+#   движок -> воркер: (request_id, ok, result | exception)
+#                     (None, event, payload) - события без запроса (state, reindex, ...)
+# Запрос в очереди движка снимается вызовом "cancel" с его request_id
+# (так HTTP-воркер отказывается от запроса, дедлайн которого истёк в очереди).
+# Дедлайны передаются как есть: time.monotonic() на Linux общий для всех процессов хоста.
+# -----------------------
+
+
+class _RemoteFuture(Future):
+    """Future запроса к движку: cancel() снимает запрос и в очереди движка."""
+
+    def __init__(self, client: "EngineClient", request_id: int):
+        super().__init__()
+        self._client = client
+        self._request_id = request_id
+
+    def cancel(self) -> bool:
+        if self.done() or not self._client._cancel(self._request_id):
+            return False
+        return super().cancel()
+
+
+class EngineClient:
+    """
+    Подключение HTTP-воркера к процессу движка. Методы те же, что у InferenceEngine,
+    но генерация и служебные вызовы уходят в движок через одно общее соединение.
+    Токенайзер воркер держит свой (без весов модели), чтобы токенизация
+    для /tokenize и поиска по базе знаний не нагружала процесс движка.
+    """
+
+    def __init__(self, address: str = ENGINE_SOCKET, call_timeout: float = ENGINE_CALL_TIMEOUT_S):
+        self.address = address
+        self.call_timeout = call_timeout
+        self._conn = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending: Dict[int, Future] = {}
+        self._state = {"accepting": False, "model": None}
+        self._listeners: Dict[str, List[Callable[[Any], None]]] = {}
+        self._tokenizer = (None, None)
+        self._tokenizer_lock = threading.Lock()
+
+    def start(self) -> None:
+        try:
+            self._connection()
+        except EngineUnavailable as e:
+            # Движок ещё стартует - подключимся при первом запросе
+            logger.error("STARTUP: %s", str(e))
+
+    def _connection(self):
+        with self._lock:
+            if self._conn is None:
+                try:
+                    conn = Client(self.address, family="AF_UNIX")
+                except OSError as e:
+                    raise EngineUnavailable(f"engine is not reachable at {self.address}: {e}")
+                self._conn = conn
+                threading.Thread(target=self._reader, args=(conn,), name="engine-client", daemon=True).start()
+            return self._conn
+
+    def _reader(self, conn) -> None:
+        while True:
+            try:
+                request_id, head, body = conn.recv()
+            except Exception:
+                # Закрытый сокет или сообщение, которое не удалось разобрать
+                break
+            if request_id is None:
+                self._on_event(head, body)
+                continue
+            future = self._pending.pop(request_id, None)
+            if future is None or future.done():
+                continue
+            if head:
+                future.set_result(body)
+            else:
+                future.set_exception(body)
+
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+            pending, self._pending = self._pending, {}
+        self._state = {"accepting": False, "model": None}
+        for future in pending.values():
+            future.set_exception(EngineUnavailable("engine connection lost"))
+        logger.error("ENGINE: connection to %s lost", self.address)
+
+    def _on_event(self, event: str, payload: Any) -> None:
+        if event == "state":
+            self._state = payload
+        # Колбэки выполняются в потоке чтения сокета - долгую работу выносите в свой поток
+        for fn in self._listeners.get(event, ()):
+            try:
+                fn(payload)
+            except Exception as e:
+                logger.error("ENGINE: event %r handler failed: %s", event, str(e))
+
+    def call(self, method: str, **kwargs) -> Future:
+        request_id = next(self._ids)
+        future = _RemoteFuture(self, request_id)
+        conn = self._connection()
+        with self._lock:
+            self._pending[request_id] = future
+            try:
+                conn.send((request_id, method, kwargs))
+            except (OSError, ValueError) as e:
+                self._pending.pop(request_id, None)
+                raise EngineUnavailable(f"engine connection failed: {e}")
+        return future
+
+    def _call_sync(self, method: str, **kwargs) -> Any:
+        return self.call(method, **kwargs).result(timeout=self.call_timeout)
+
+    def _cancel(self, request_id: int) -> bool:
+        """Снять запрос в движке; False - он уже выполняется, выполнен или связи нет."""
+        try:
+            cancelled = self._call_sync("cancel", request_id=request_id)
+        except (EngineUnavailable, FutureTimeout):
+            return False
+        if cancelled:
+            self._pending.pop(request_id, None)
+        return cancelled
+
+    def accepting(self) -> bool:
+        if self._conn is None:
+            try:
+                self._connection()
+            except EngineUnavailable:
+                return False
+        return self._state["accepting"]
+
+    def tokenizer(self):
+        """Токенайзер модели, которую сейчас обслуживает движок (перечитывается после перезагрузки)."""
+        name = self._state.get("model")
+        if name is None:
+            return None
+        with self._tokenizer_lock:
+            loaded_name, tokenizer = self._tokenizer
+            if loaded_name != name:
+                tokenizer = load_tokenizer(name)
+                self._tokenizer = (name, tokenizer)
+            return tokenizer
+
+    def generate(self, item: GenerationInput) -> Future:
+        return self.call("generate", item=item)
+
+    def embed(
+        self,
+        token_ids: List[List[int]],
+        pooling: str = "mean",
+        normalize: bool = True,
+        deadline: Optional[float] = None,
+    ) -> Future:
+        return self.call("embed", token_ids=token_ids, pooling=pooling, normalize=normalize, deadline=deadline)
+
+    def adapters(self) -> dict:
+        return self._call_sync("adapters")
+
+    def start_reload(self, model_name: Optional[str] = None, strategy: Optional[str] = None) -> bool:
+        return self._call_sync("start_reload", model_name=model_name, strategy=strategy)
+
+    def reload_status(self) -> dict:
+        return self._call_sync("reload_status")
+
+    def ready_info(self) -> Optional[dict]:
+        try:
+            return self._call_sync("ready_info")
+        except EngineUnavailable:
+            return None
+
+    def health(self, docker: bool = False) -> dict:
+        return self._call_sync("health", docker=docker)
+
+    def retrieval_embed(self, texts: List[str], model_name: str) -> Future:
+        return self.call("retrieval_embed", texts=texts, model_name=model_name)
+
+    def broadcast(self, event: str, payload: Any = None) -> None:
+        """Событие всем HTTP-воркерам, подключённым к движку (включая этот)."""
+        self._call_sync("broadcast", event=event, payload=payload)
+
+    def subscribe(self, event: str, fn: Callable[[Any], None]) -> None:
+        self._listeners.setdefault(event, []).append(fn)
+
+    def shutdown(self, timeout: float = SHUTDOWN_DRAIN_TIMEOUT_S) -> bool:
+        # Незавершённых запросов к этому моменту нет: uvicorn дождался их до shutdown
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+        return True
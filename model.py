@@ -1,32 +1,65 @@
 import os
+import time
 import logging
-from typing import Optional
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import numpy as np
+import torch
 from dotenv import load_dotenv
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM, QuantizedCache, StaticCache, StoppingCriteria, StoppingCriteriaList,
+)
+
+from engine_client import EmbeddingResult, GenerationInput, GenerationResult
+from prompts import BASE_MODEL_NAME, get_prompt_template, load_tokenizer
 
 load_dotenv()
 
-BASE_MODEL_NAME = os.getenv("BASE_MODEL_NAME", "unsloth/llama-3-8b-Instruct-bnb-4bit")
+# Режим декодирования со статическим KV-кэшем (см. StaticDecodeCache)
+STATIC_KV_CACHE = os.getenv("STATIC_KV_CACHE", "false").lower() == "true"
+# Длина статического кэша: промпт + max_new_tokens; длиннее - обычный динамический кэш
+STATIC_KV_CACHE_MAX_LEN = int(os.getenv("STATIC_KV_CACHE_MAX_LEN", "2048"))
+# Компилировать шаг декодирования через torch.compile (работает только на CUDA)
+TORCH_COMPILE_DECODE = os.getenv("TORCH_COMPILE_DECODE", "true").lower() == "true"
+
+# Квантованный KV-кэш (см. KVCacheQuantization): пусто - fp16, int8 или int4
+KV_CACHE_QUANT = os.getenv("KV_CACHE_QUANT", "").lower()
+# hqq (int8/int4) или quanto (optimum-quanto, только int4)
+KV_CACHE_QUANT_BACKEND = os.getenv("KV_CACHE_QUANT_BACKEND", "hqq").lower()
+# Сколько последних токенов каждой строки хранится без квантования (fp16)
+KV_CACHE_RESIDUAL_LEN = int(os.getenv("KV_CACHE_RESIDUAL_LEN", "128"))
+# Размер группы значений с общим масштабом/нулём
+KV_CACHE_QUANT_GROUP_SIZE = int(os.getenv("KV_CACHE_QUANT_GROUP_SIZE", "64"))
+
+# Эмбеддинги (/embed): сколько токенов (строки x длина с паддингом) в одном forward-проходе
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "8192"))
+# Способы свернуть скрытые состояния текста в один вектор
+EMBED_POOLING = ("mean", "last")
 
 logger = logging.getLogger("uii-llm-api")
 
-def load_model_and_tokenizer(logger: Optional[logging.Logger] = None):
+
+def load_model_and_tokenizer(logger: Optional[logging.Logger] = None, model_name: Optional[str] = None):
     """
-    ИНФЕРЕНС-ЗАГРУЗКА базовой модели (без обучения и адаптеров):
+    ИНФЕРЕНС-ЗАГРУЗКА базовой модели (без обучения):
     1) Загружаем токенайзер из базовой модели
     2) Загружаем LLaMA 3 8B в 4-bit режиме
+    LoRA-адаптеры подключаются поверх этой модели по запросу (см. adapters.py).
+    model_name - имя/путь модели; по умолчанию BASE_MODEL_NAME.
     """
     if logger is None:
         logger = logging.getLogger("model")
+    model_name = model_name or BASE_MODEL_NAME
 
-    logger.warning("MODEL: BASE_MODEL_NAME=%s", BASE_MODEL_NAME)
+    logger.warning("MODEL: BASE_MODEL_NAME=%s", model_name)
 
     logger.warning("MODEL: loading tokenizer from base model")
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_NAME)
+    tokenizer = load_tokenizer(model_name)
 
     logger.warning("MODEL: loading base model in 4-bit (first run may download ~16GB)")
     model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL_NAME,
+        model_name,
         device_map="auto",
         load_in_4bit=True,
     )
@@ -36,26 +69,456 @@ def load_model_and_tokenizer(logger: Optional[logging.Logger] = None):
     return model, tokenizer
 
 
-def build_llama3_prompt(system_prompt: str, user_prompt: str) -> str:
+@dataclass
+class GenerationState:
+    """Что сейчас происходит в цикле генерации (читает фоновая телеметрия)."""
+    active_sequences: int = 0
+    kv_cache_bytes: int = 0
+
+
+GENERATION_STATE = GenerationState()
+
+
+def kv_cache_bytes_per_token(model) -> int:
+    """Сколько байт KV-кэша занимает один токен одной последовательности."""
+    config = model.config
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    dtype = getattr(model, "dtype", torch.float16)
+    return 2 * config.num_hidden_layers * kv_heads * head_dim * torch.finfo(dtype).bits // 8
+
+
+class KVCacheQuantization:
+    """
+    Квантованный KV-кэш (transformers QuantizedCache, схема KIVI).
+
+    Последние residual_length токенов каждой строки хранятся в исходной точности,
+    всё более старое - в int8/int4 с масштабом и нулём на группу из group_size
+    значений. KV-кэш занимает в 2-4 раза меньше памяти, поэтому в ту же GPU
+    помещается больше одновременных последовательностей; цена - квантование/
+    деквантование на каждом шаге и небольшая потеря точности внимания.
+
+    Кэш создаётся на каждый вызов generate(). Со статическим кэшем не сочетается:
+    батчи, которые помещаются в StaticDecodeCache, идут через него. Если генерация
+    в этом режиме падает (нет пакета hqq/optimum-quanto, неподходящий group_size),
+    режим отключается и сервис продолжает работать с обычным fp16-кэшем.
+    """
+
+    BITS = {"int8": 8, "int4": 4}
+    BACKEND_BITS = {"hqq": (8, 4), "quanto": (4,)}
+
+    def __init__(
+        self,
+        mode: str,
+        backend: str = KV_CACHE_QUANT_BACKEND,
+        residual_length: int = KV_CACHE_RESIDUAL_LEN,
+        group_size: int = KV_CACHE_QUANT_GROUP_SIZE,
+    ):
+        if mode not in self.BITS:
+            raise ValueError(f"unknown KV cache quantization {mode!r}, expected one of {tuple(self.BITS)}")
+        if self.BITS[mode] not in self.BACKEND_BITS.get(backend, ()):
+            raise ValueError(f"backend {backend!r} does not support {mode} KV cache")
+        self.mode = mode
+        self.nbits = self.BITS[mode]
+        self.backend = backend
+        self.residual_length = residual_length
+        self.group_size = group_size
+        self.enabled = True
+
+    @classmethod
+    def from_env(cls) -> Optional["KVCacheQuantization"]:
+        """
+        Режим из KV_CACHE_QUANT. Неверная пара режим/бэкенд (например, int8 с quanto) -
+        ошибка в лог и обычный fp16-кэш, как при сбое бэкенда, а не отказ старта сервиса.
+        """
+        if not KV_CACHE_QUANT:
+            return None
+        try:
+            return cls(KV_CACHE_QUANT)
+        except ValueError as e:
+            logger.error("KV CACHE QUANT: %s, using fp16 KV cache", str(e))
+            return None
+
+    def new_cache(self, config) -> QuantizedCache:
+        return QuantizedCache(
+            backend=self.backend,
+            config=config,
+            nbits=self.nbits,
+            q_group_size=self.group_size,
+            residual_length=self.residual_length,
+        )
+
+    def cache_bytes(self, fp_bytes_per_token: int, length: int, dtype_bits: int = 16) -> int:
+        """
+        Оценка памяти кэша одной строки длиной length: окно residual_length в исходной
+        точности + остальное в nbits на значение и два dtype_bits (масштаб, ноль) на группу.
+        """
+        residual = min(length, self.residual_length)
+        quantized_ratio = (self.nbits + 2 * dtype_bits / self.group_size) / dtype_bits
+        return int(fp_bytes_per_token * (residual + (length - residual) * quantized_ratio))
+
+    def disable(self, reason: str) -> None:
+        logger.error("KV CACHE QUANT: disabled, falling back to fp16 cache: %s", reason)
+        self.enabled = False
+
+
+class RowLimitsCriteria(StoppingCriteria):
+    """
+    Остановка по строкам батча: у каждой строки свой max_new_tokens и свой дедлайн.
+    Запоминает, на каком шаге и по какой причине строка была остановлена,
+    и на каждом шаге обновляет GENERATION_STATE.
+    """
+
+    def __init__(
+        self,
+        prompt_len: int,
+        max_new_tokens: List[int],
+        deadlines: List[Optional[float]],
+        eos_token_ids: set = frozenset(),
+        kv_bytes_per_token: int = 0,
+        kv_cache_len: Optional[int] = None,
+        kv_quant: Optional[KVCacheQuantization] = None,
+    ):
+        self.prompt_len = prompt_len
+        self.max_new_tokens = max_new_tokens
+        self.deadlines = deadlines
+        self.eos_token_ids = eos_token_ids
+        self.kv_bytes_per_token = kv_bytes_per_token
+        # Для статического кэша память выделена сразу на kv_cache_len токенов
+        self.kv_cache_len = kv_cache_len
+        # Для квантованного кэша память считается по квантованному размеру
+        self.kv_quant = kv_quant
+        self.stopped: List[Optional[tuple]] = [None] * len(max_new_tokens)
+        self.eos_seen = [False] * len(max_new_tokens)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[-1] - self.prompt_len
+        now = time.monotonic()
+        for i, (limit, deadline) in enumerate(zip(self.max_new_tokens, self.deadlines)):
+            if self.stopped[i] is not None:
+                continue
+            if generated >= limit:
+                self.stopped[i] = (generated, "length")
+            elif deadline is not None and now >= deadline:
+                self.stopped[i] = (generated, "truncated")
+        done = [s is not None for s in self.stopped]
+
+        for i, token in enumerate(input_ids[:, -1].tolist()):
+            self.eos_seen[i] = self.eos_seen[i] or token in self.eos_token_ids
+        GENERATION_STATE.active_sequences = sum(
+            1 for d, e in zip(done, self.eos_seen) if not (d or e)
+        )
+        kv_len = self.kv_cache_len or input_ids.shape[-1]
+        if self.kv_quant is not None:
+            row_bytes = self.kv_quant.cache_bytes(self.kv_bytes_per_token, kv_len)
+        else:
+            row_bytes = kv_len * self.kv_bytes_per_token
+        GENERATION_STATE.kv_cache_bytes = input_ids.shape[0] * row_bytes
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def _eos_token_ids(model, tokenizer) -> set:
+    eos = model.generation_config.eos_token_id
+    ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+    ids.add(tokenizer.convert_tokens_to_ids("<|eot_id|>"))
+    ids.discard(None)
+    return ids
+
+
+def _left_pad(prompt_ids: List[List[int]], pad_token_id: int, device) -> dict:
+    """Склеивает id промптов в тензор с паддингом слева (как нужно decoder-only модели)."""
+    width = max(len(ids) for ids in prompt_ids)
+    input_ids = torch.full((len(prompt_ids), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompt_ids), width), dtype=torch.long)
+    for row, ids in enumerate(prompt_ids):
+        input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, width - len(ids):] = 1
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+
+class StaticDecodeCache:
+    """
+    Статический KV-кэш и torch.compile шага декодирования.
+
+    Для каждого бакета размера батча (1, 2, 4, ...) один раз выделяется StaticCache
+    на max_len токенов, а батч дополняется пустыми строками до размера бакета.
+    Формы тензоров на шаге декодирования не меняются, поэтому скомпилированный
+    forward (см. decode_forward) компилируется один раз на бакет - число
+    перекомпиляций ограничено числом бакетов. Батчи длиннее max_len идут обычным
+    путём с динамическим кэшем. Если компиляция или генерация в этом режиме падает,
+    режим отключается и сервис продолжает работать с динамическим кэшем.
+    """
+
+    WARMUP_NEW_TOKENS = 4
+
+    def __init__(
+        self,
+        config,
+        max_len: int = STATIC_KV_CACHE_MAX_LEN,
+        max_batch_size: int = 1,
+        compile: bool = TORCH_COMPILE_DECODE,
+    ):
+        self.config = config
+        self.max_len = max_len
+        self.compile = compile
+        self.buckets = [1]
+        while self.buckets[-1] < max_batch_size:
+            self.buckets.append(self.buckets[-1] * 2)
+        self.enabled = True
+        self._caches: Dict[int, StaticCache] = {}
+        # (исходный forward, скомпилированный forward) - компилируется при первом батче
+        self._compiled: Optional[tuple] = None
+
+    def bucket_for(self, batch_size: int, total_len: int) -> Optional[int]:
+        if not self.enabled or total_len > self.max_len:
+            return None
+        return next((b for b in self.buckets if b >= batch_size), None)
+
+    def acquire(self, bucket: int) -> StaticCache:
+        cache = self._caches.get(bucket)
+        if cache is None:
+            cache = StaticCache(config=self.config, max_cache_len=self.max_len)
+            self._caches[bucket] = cache
+        else:
+            cache.reset()
+        return cache
+
+    def disable(self, reason: str) -> None:
+        logger.error("STATIC KV CACHE: disabled, falling back to dynamic cache: %s", reason)
+        self.enabled = False
+        self._caches.clear()
+        self._compiled = None
+
+    def compile_skip_reason(self, model) -> Optional[str]:
+        """Почему шаг декодирования не будет компилироваться; None - будет."""
+        if not self.compile:
+            return "TORCH_COMPILE_DECODE=false"
+        if model.device.type != "cuda":
+            return f"device {model.device.type}, torch.compile is used only on CUDA"
+        return None
+
+    @contextmanager
+    def decode_forward(self, model):
+        """
+        На время generate() подменяет forward модели: шаги декодирования (один новый
+        токен на строку, статический кэш) идут через torch.compile, prefill - обычным
+        forward. Автокомпиляция transformers здесь не годится: для 4-битной bnb-модели
+        она молча выключается (hf_quantizer.is_compileable == False).
+        """
+        if self.compile_skip_reason(model) is not None:
+            yield
+            return
+        causal_lm = model.get_base_model() if getattr(model, "peft_config", None) else model
+        eager = causal_lm.forward
+        if self._compiled is None or self._compiled[0] != eager:
+            self._compiled = (eager, torch.compile(eager, mode="reduce-overhead", dynamic=False))
+        compiled = self._compiled[1]
+
+        def forward(*args, **kwargs):
+            input_ids = kwargs.get("input_ids")
+            if (input_ids is not None and input_ids.shape[-1] == 1
+                    and isinstance(kwargs.get("past_key_values"), StaticCache)):
+                return compiled(*args, **kwargs)
+            return eager(*args, **kwargs)
+
+        # Вызовы generate() идут только из потока планировщика, так что подмена на время вызова безопасна
+        previous = causal_lm.__dict__.get("forward")
+        causal_lm.forward = forward
+        try:
+            yield
+        finally:
+            if previous is not None:
+                causal_lm.forward = previous
+            else:
+                del causal_lm.forward
+
+    def warmup(self, model, tokenizer, system_prompt: str = "") -> None:
+        """Прогрев: выделяет кэши и компилирует декодирование для всех бакетов."""
+        skip_reason = self.compile_skip_reason(model)
+        if skip_reason is not None:
+            logger.warning("STATIC KV CACHE: decode step is not compiled: %s", skip_reason)
+        for bucket in self.buckets:
+            if not self.enabled:
+                return
+            t0 = time.time()
+            items = [GenerationInput(question="warmup", max_new_tokens=self.WARMUP_NEW_TOKENS)] * bucket
+            generate_batch(items, model=model, tokenizer=tokenizer, system_prompt=system_prompt, static_cache=self)
+            logger.warning("STATIC KV CACHE: warmed up batch bucket %d in %.1fs (%s)",
+                           bucket, time.time() - t0, "compiled" if skip_reason is None else "eager")
+
+
+def _generate_rows(
+    items: List[GenerationInput],
+    prompt_ids: List[List[int]],
+    model,
+    tokenizer,
+    eos_token_ids: set,
+    cache: Optional[StaticCache] = None,
+    rows: Optional[int] = None,
+    static_cache: Optional[StaticDecodeCache] = None,
+    kv_quant: Optional[KVCacheQuantization] = None,
+):
     """
-    Формат промпта для LLaMA 3 Instruct.
-    Важно: если нарушить формат, качество ответов часто падает.
+    Один вызов model.generate(). rows - размер батча с учётом пустых строк
+    (для статического кэша), cache - заранее выделенный StaticCache,
+    static_cache - его владелец (компилирует шаг декодирования),
+    kv_quant - вместо него создать квантованный кэш.
+    Возвращает (outputs, criteria, prompt_len) только для настоящих строк.
     """
-    return (
-        f"<|start_header_id|>system<|end_header_id|>\n{system_prompt}<|eot_id|>"
-        f"<|start_header_id|>user<|end_header_id|>\n{user_prompt}<|eot_id|>"
-        f"<|start_header_id|>assistant<|end_header_id|>\n"
+    # Пустые строки-заглушки останавливаются сразу после первого токена
+    filler = (rows or len(items)) - len(items)
+    items = items + [GenerationInput(question="", max_new_tokens=0)] * filler
+    prompt_ids = prompt_ids + [prompt_ids[0]] * filler
+
+    inputs = _left_pad(prompt_ids, tokenizer.pad_token_id, device=model.device)
+    prompt_len = inputs["input_ids"].shape[-1]
+    criteria = RowLimitsCriteria(
+        prompt_len=prompt_len,
+        max_new_tokens=[i.max_new_tokens for i in items],
+        deadlines=[i.deadline for i in items],
+        eos_token_ids=eos_token_ids,
+        kv_bytes_per_token=kv_cache_bytes_per_token(model),
+        kv_cache_len=cache.max_cache_len if cache is not None else None,
+        kv_quant=kv_quant,
     )
+    kwargs = {}
+    if getattr(model, "peft_config", None):
+        # PEFT mixed-batch: у каждой строки свой адаптер поверх общих весов
+        kwargs["adapter_names"] = [i.adapter or "__base__" for i in items]
+    elif any(i.adapter for i in items):
+        raise ValueError("adapter requested, but no LoRA adapters are loaded into the model")
+    if cache is not None:
+        kwargs["past_key_values"] = cache
+        # Шаг декодирования компилирует сам StaticDecodeCache (decode_forward)
+        kwargs["disable_compile"] = True
+    elif kv_quant is not None:
+        kwargs["past_key_values"] = kv_quant.new_cache(model.config)
+
+    if items[0].temperature > 0:
+        kwargs.update(do_sample=True, temperature=items[0].temperature)
+    else:
+        # temperature <= 0 - жадное декодирование (в том числе при деградации под нагрузкой)
+        kwargs.update(do_sample=False, temperature=None, top_p=None, top_k=None)
 
+    GENERATION_STATE.active_sequences = len(items) - filler
+    try:
+        with static_cache.decode_forward(model) if static_cache is not None else nullcontext():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max(i.max_new_tokens for i in items),
+                stopping_criteria=StoppingCriteriaList([criteria]),
+                pad_token_id=tokenizer.pad_token_id,
+                **kwargs,
+            )
+    finally:
+        GENERATION_STATE.active_sequences = 0
+        GENERATION_STATE.kv_cache_bytes = 0
+    return outputs[: len(items) - filler], criteria, prompt_len
 
-def clean_llama3_output(decoded: str) -> str:
+
+def generate_batch(
+    items: List[GenerationInput],
+    model,
+    tokenizer,
+    system_prompt: str,
+    static_cache: Optional[StaticDecodeCache] = None,
+    kv_quant: Optional[KVCacheQuantization] = None,
+) -> List[GenerationResult]:
+    """
+    Генерация ответов для батча вопросов одним вызовом model.generate().
+    Все элементы батча должны иметь одинаковую temperature; max_new_tokens,
+    дедлайн, LoRA-адаптер и системный промпт у каждого свои. Если передан static_cache и батч
+    в него помещается, декодирование идёт со статическим KV-кэшем, иначе при
+    переданном kv_quant - с квантованным.
+    """
+    temperatures = {i.temperature for i in items}
+    if len(temperatures) != 1:
+        raise ValueError(f"batch items must share temperature, got {sorted(temperatures)}")
+
+    template = get_prompt_template(tokenizer)
+    prompt_ids = template.encode_batch(
+        [i.system_prompt if i.system_prompt is not None else system_prompt for i in items],
+        [i.question for i in items],
+    )
+    eos_token_ids = _eos_token_ids(model, tokenizer)
+
+    generated = None
+    if static_cache is not None:
+        total_len = max(len(ids) for ids in prompt_ids) + max(i.max_new_tokens for i in items)
+        bucket = static_cache.bucket_for(len(items), total_len)
+        if bucket is not None:
+            try:
+                generated = _generate_rows(
+                    items, prompt_ids, model, tokenizer, eos_token_ids,
+                    cache=static_cache.acquire(bucket), rows=bucket, static_cache=static_cache,
+                )
+            except torch.cuda.OutOfMemoryError:
+                raise
+            except Exception as e:
+                static_cache.disable(str(e))
+    if generated is None and kv_quant is not None and kv_quant.enabled:
+        try:
+            generated = _generate_rows(items, prompt_ids, model, tokenizer, eos_token_ids, kv_quant=kv_quant)
+        except torch.cuda.OutOfMemoryError:
+            raise
+        except Exception as e:
+            kv_quant.disable(str(e))
+    if generated is None:
+        generated = _generate_rows(items, prompt_ids, model, tokenizer, eos_token_ids)
+    outputs, criteria, prompt_len = generated
+
+    completions = []
+    for row, output in enumerate(outputs):
+        new_tokens = output[prompt_len:].tolist()
+        # Первый eos - либо настоящий конец ответа, либо паддинг после остановки строки
+        first_eos = next((k for k, t in enumerate(new_tokens) if t in eos_token_ids), None)
+        stopped = criteria.stopped[row]
+        if first_eos is not None and (stopped is None or first_eos < stopped[0]):
+            completions.append(("stop", new_tokens[:first_eos], first_eos + 1))
+        elif stopped is not None:
+            completions.append((stopped[1], new_tokens[:stopped[0]], stopped[0]))
+        else:
+            completions.append(("length", new_tokens, len(new_tokens)))
+
+    # Декодируем только сгенерированные токены - разбирать строку с заголовками не нужно
+    texts = template.decode_batch([c[1] for c in completions])
+    return [
+        GenerationResult(
+            text=text.strip(),
+            stop_reason=stop_reason,
+            prompt_tokens=len(ids),
+            completion_tokens=n_tokens,
+        )
+        for text, (stop_reason, _, n_tokens), ids in zip(texts, completions, prompt_ids)
+    ]
+
+
+def generate_completion(
+    question: str,
+    model,
+    tokenizer,
+    system_prompt: str,
+    max_new_tokens: int = 180,
+    temperature: float = 0.7,
+    deadline: Optional[float] = None,
+    adapter: Optional[str] = None,
+    kv_quant: Optional[KVCacheQuantization] = None,
+) -> GenerationResult:
     """
-    Чистим ответ: убираем служебные токены и оставляем только текст ассистента.
+    Генерация одного ответа с информацией о причине остановки.
+    deadline - момент (time.monotonic()), после которого декодирование
+    прекращается и возвращается уже сгенерированный текст.
     """
-    assistant_prefix = "<|start_header_id|>assistant<|end_header_id|>\n"
-    if assistant_prefix in decoded:
-        decoded = decoded.split(assistant_prefix)[-1]
-    return decoded.replace("<|eot_id|>", "").strip()
+    item = GenerationInput(
+        question=question,
+        max_new_tokens=max_new_tokens,
+        temperature=temperature,
+        deadline=deadline,
+        adapter=adapter,
+    )
+    return generate_batch(
+        [item], model=model, tokenizer=tokenizer, system_prompt=system_prompt, kv_quant=kv_quant,
+    )[0]
 
 
 def generate_answer(
@@ -65,16 +528,101 @@ def generate_answer(
     system_prompt: str,
     max_new_tokens: int = 180,
     temperature: float = 0.7,
+    kv_quant: Optional[KVCacheQuantization] = None,
 ) -> str:
-    prompt = build_llama3_prompt(system_prompt, question)
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-
-    outputs = model.generate(
-        **inputs,
+    return generate_completion(
+        question=question,
+        model=model,
+        tokenizer=tokenizer,
+        system_prompt=system_prompt,
         max_new_tokens=max_new_tokens,
         temperature=temperature,
-        do_sample=True,
-    )
+        kv_quant=kv_quant,
+    ).text
+
+
+def length_buckets(lengths: List[int], max_tokens: int = EMBED_BATCH_TOKENS) -> List[List[int]]:
+    """
+    Группирует тексты по длине: индексы сортируются по числу токенов и режутся
+    на группы, в которых строки x длина самого длинного текста <= max_tokens.
+    Короткие тексты не дополняются паддингом до длинных, а один длинный текст
+    не раздувает батч. Текст длиннее max_tokens идёт отдельной группой.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        # Индексы отсортированы по возрастанию: ширина группы - длина текущего текста
+        if current and (len(current) + 1) * max(lengths[i], 1) > max_tokens:
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
 
-    decoded = tokenizer.decode(outputs[0], skip_special_tokens=False)
-    return clean_llama3_output(decoded)
+def embed_batch(
+    token_ids: List[List[int]],
+    model,
+    tokenizer,
+    pooling: str = "mean",
+    normalize: bool = True,
+) -> np.ndarray:
+    """
+    Эмбеддинги текстов одним forward-проходом базовой модели: без декодирования
+    и без lm_head, только последний слой скрытых состояний.
+    token_ids - токены текстов без служебных (как encode_texts); <|begin_of_text|>
+    добавляется здесь и в mean-пулинг не входит (у LLaMA его состояние на порядки
+    больше остальных и перетянуло бы среднее). pooling="last" - состояние
+    последнего токена. LoRA-адаптеры на время прохода выключаются.
+    """
+    if pooling not in EMBED_POOLING:
+        raise ValueError(f"unknown pooling {pooling!r}, expected one of {EMBED_POOLING}")
+    prefix_ids = get_prompt_template(tokenizer).prefix_ids
+    inputs = _left_pad([prefix_ids + ids for ids in token_ids], tokenizer.pad_token_id, device=model.device)
+    mask = inputs["attention_mask"]
+    # Паддинг слева: позиции считаются от первого настоящего токена, как в generate()
+    position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+
+    peft = bool(getattr(model, "peft_config", None))
+    decoder = (model.get_base_model() if peft else model).get_decoder()
+    with torch.no_grad(), (model.disable_adapter() if peft else nullcontext()):
+        hidden = decoder(
+            input_ids=inputs["input_ids"], attention_mask=mask, position_ids=position_ids, use_cache=False,
+        ).last_hidden_state.float()
+
+    if pooling == "last":
+        vectors = hidden[:, -1]
+    else:
+        weights = mask.clone()
+        width = mask.shape[-1]
+        for row, ids in enumerate(token_ids):
+            if ids:
+                weights[row, width - len(ids) - len(prefix_ids): width - len(ids)] = 0
+        weights = weights.unsqueeze(-1).to(hidden.dtype)
+        vectors = (hidden * weights).sum(dim=1) / weights.sum(dim=1).clamp(min=1.0)
+    if normalize:
+        vectors = torch.nn.functional.normalize(vectors, dim=-1)
+    return vectors.cpu().numpy().astype(np.float32, copy=False)
+
+
+def embed_texts(
+    token_ids: List[List[int]],
+    model,
+    tokenizer,
+    pooling: str = "mean",
+    normalize: bool = True,
+    max_batch_tokens: int = EMBED_BATCH_TOKENS,
+) -> EmbeddingResult:
+    """Эмбеддинги любого числа текстов: батчи из текстов близкой длины (length_buckets)."""
+    vectors: List[Optional[np.ndarray]] = [None] * len(token_ids)
+    for bucket in length_buckets([len(ids) for ids in token_ids], max_batch_tokens):
+        batch = embed_batch([token_ids[i] for i in bucket], model, tokenizer, pooling=pooling, normalize=normalize)
+        for i, vector in zip(bucket, batch):
+            vectors[i] = vector
+    hidden_size = model.config.hidden_size
+    return EmbeddingResult(
+        vectors=np.stack(vectors) if vectors else np.zeros((0, hidden_size), dtype=np.float32),
+        token_counts=[len(ids) for ids in token_ids],
+    )
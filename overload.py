@@ -0,0 +1,191 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge
+
+load_dotenv()
+
+# Деградация под нагрузкой. Давление - оценка ожидания в очереди:
+# токены, которые ещё предстоит сгенерировать, / текущая скорость генерации (токен/с).
+OVERLOAD_POLICY = os.getenv("OVERLOAD_POLICY", "true").lower() == "true"
+# С какого ожидания (сек) включается каждая ступень
+OVERLOAD_CAP_WAIT_S = float(os.getenv("OVERLOAD_CAP_WAIT_S", "5"))
+OVERLOAD_GREEDY_WAIT_S = float(os.getenv("OVERLOAD_GREEDY_WAIT_S", "10"))
+OVERLOAD_CACHE_ONLY_WAIT_S = float(os.getenv("OVERLOAD_CACHE_ONLY_WAIT_S", "20"))
+OVERLOAD_REJECT_WAIT_S = float(os.getenv("OVERLOAD_REJECT_WAIT_S", "40"))
+# Глубина очереди, при которой новые запросы отклоняются независимо от оценки ожидания
+OVERLOAD_MAX_QUEUE_DEPTH = int(os.getenv("OVERLOAD_MAX_QUEUE_DEPTH", "256"))
+# Верхняя граница Retry-After при отказе, сек
+OVERLOAD_MAX_RETRY_AFTER_S = float(os.getenv("OVERLOAD_MAX_RETRY_AFTER_S", "60"))
+# До скольки токенов урезается max_new_tokens под нагрузкой
+OVERLOAD_CAP_TOKENS = int(os.getenv("OVERLOAD_CAP_TOKENS", "96"))
+# Кэш готовых ответов для ступени cache_only
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "3600"))
+
+# Ступени по возрастанию давления; каждая включает все предыдущие
+LEVELS = ("normal", "cap_tokens", "greedy", "cache_only", "reject")
+
+logger = logging.getLogger("uii-llm-api")
+
+LLM_OVERLOAD_LEVEL = Gauge("llm_overload_level", "Текущая ступень деградации (0 - normal ... 4 - reject)")
+LLM_ESTIMATED_QUEUE_WAIT = Gauge(
+    "llm_estimated_queue_wait_seconds", "Оценка ожидания: токены в очереди / скорость генерации")
+LLM_TOKEN_THROUGHPUT = Gauge("llm_token_throughput", "Скорость генерации, токенов/с (скользящее среднее по батчам)")
+LLM_PENDING_TOKENS = Gauge("llm_pending_tokens", "Токены, которые ещё предстоит сгенерировать принятым запросам")
+LLM_DEGRADATIONS_TOTAL = Counter(
+    "llm_degradations_total",
+    "Запросы, обслуженные с деградацией (cap_tokens, greedy, cached) или отклонённые (rejected)",
+    ["action"],
+)
+LLM_RESPONSE_CACHE_TOTAL = Counter("llm_response_cache_total", "Обращения к кэшу ответов", ["result"])
+
+
+@dataclass
+class OverloadDecision:
+    level: int
+    estimated_wait: float
+
+    @property
+    def name(self) -> str:
+        return LEVELS[self.level]
+
+
+class OverloadPolicy:
+    """
+    Выбор ступени деградации по глубине очереди и скорости генерации.
+
+    Движок сообщает о принятых запросах (admit/release - сколько токенов они
+    ещё могут сгенерировать) и о каждом выполненном батче (observe_batch -
+    сколько токенов за сколько секунд). Ожидание нового запроса оценивается
+    как pending_tokens / throughput и сравнивается с порогами ступеней.
+    Пока скорость ещё не измерена, работает только ограничение по глубине очереди.
+    """
+
+    EMA_ALPHA = 0.3
+
+    def __init__(
+        self,
+        enabled: bool = OVERLOAD_POLICY,
+        thresholds: tuple = (OVERLOAD_CAP_WAIT_S, OVERLOAD_GREEDY_WAIT_S, OVERLOAD_CACHE_ONLY_WAIT_S, OVERLOAD_REJECT_WAIT_S),
+        max_queue_depth: int = OVERLOAD_MAX_QUEUE_DEPTH,
+        cap_tokens: int = OVERLOAD_CAP_TOKENS,
+        max_retry_after: float = OVERLOAD_MAX_RETRY_AFTER_S,
+    ):
+        self.enabled = enabled
+        self.thresholds = thresholds
+        self.max_queue_depth = max_queue_depth
+        self.cap_tokens = cap_tokens
+        self.max_retry_after = max_retry_after
+        self.throughput: Optional[float] = None
+        # Шагов декодирования в секунду (строки батча декодируются параллельно) - для оценки
+        # длительности отдельного запроса
+        self.step_rate: Optional[float] = None
+        self.pending_tokens = 0
+        self._lock = threading.Lock()
+
+    def estimated_wait(self) -> float:
+        if not self.throughput:
+            return 0.0
+        return self.pending_tokens / self.throughput
+
+    def decide(self, queue_depth: int) -> OverloadDecision:
+        wait = self.estimated_wait()
+        level = 0
+        if self.enabled:
+            level = sum(1 for threshold in self.thresholds if wait >= threshold)
+            if queue_depth >= self.max_queue_depth:
+                level = LEVELS.index("reject")
+        LLM_OVERLOAD_LEVEL.set(level)
+        LLM_ESTIMATED_QUEUE_WAIT.set(wait)
+        return OverloadDecision(level=level, estimated_wait=wait)
+
+    def retry_after(self, decision: OverloadDecision, level: str = "reject") -> float:
+        """
+        Через сколько секунд повторить запрос, отклонённый на ступени level:
+        сколько ожидание ещё выше её порога, от 1 до max_retry_after.
+        """
+        threshold = self.thresholds[LEVELS.index(level) - 1]
+        return min(max(decision.estimated_wait - threshold, 1.0), self.max_retry_after)
+
+    def admit(self, tokens: int) -> None:
+        with self._lock:
+            self.pending_tokens += tokens
+            LLM_PENDING_TOKENS.set(self.pending_tokens)
+
+    def release(self, tokens: int) -> None:
+        with self._lock:
+            self.pending_tokens = max(self.pending_tokens - tokens, 0)
+            LLM_PENDING_TOKENS.set(self.pending_tokens)
+
+    def observe_batch(self, tokens: int, seconds: float, steps: int = 0) -> None:
+        """tokens - всего токенов в батче, steps - шагов декодирования (самый длинный ответ)."""
+        if tokens <= 0 or seconds <= 0:
+            return
+        rate = tokens / seconds
+        with self._lock:
+            self.throughput = rate if self.throughput is None else (
+                self.EMA_ALPHA * rate + (1 - self.EMA_ALPHA) * self.throughput
+            )
+            LLM_TOKEN_THROUGHPUT.set(self.throughput)
+            if steps > 0:
+                step_rate = steps / seconds
+                self.step_rate = step_rate if self.step_rate is None else (
+                    self.EMA_ALPHA * step_rate + (1 - self.EMA_ALPHA) * self.step_rate
+                )
+
+    def decode_seconds(self, max_new_tokens: int) -> Optional[float]:
+        """Оценка, сколько секунд займёт ответ длиной max_new_tokens; None - скорость ещё не измерена."""
+        if not self.step_rate:
+            return None
+        return max_new_tokens / self.step_rate
+
+
+class ResponseCache:
+    """
+    LRU-кэш готовых ответов: ключ - вопрос, системный промпт (с найденными
+    фрагментами базы знаний) и адаптер. Кладутся только завершённые ответы
+    (stop_reason == "stop"); отдаются только под нагрузкой, на ступени cache_only.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL_S):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(question: str, system_prompt: Optional[str], adapter: Optional[str]) -> str:
+        normalized = " ".join(question.lower().split())
+        return hashlib.sha256(f"{adapter}\x00{system_prompt}\x00{normalized}".encode()).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._items[key]
+                entry = None
+            if entry is not None:
+                self._items.move_to_end(key)
+        LLM_RESPONSE_CACHE_TOTAL.labels(result="hit" if entry is not None else "miss").inc()
+        return entry[1] if entry is not None else None
+
+    def put(self, key: str, value) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
@@ -0,0 +1,153 @@
+"""
+Токенайзер и промпт LLaMA 3 Instruct. Модуль не импортирует torch и не грузит
+веса: им пользуются и процесс движка, и HTTP-воркеры (serve.py запускает их
+с USE_TORCH=0, чтобы transformers не подтягивал torch ради одного токенайзера).
+"""
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from transformers import AutoTokenizer
+
+load_dotenv()
+
+BASE_MODEL_NAME = os.getenv("BASE_MODEL_NAME", "unsloth/llama-3-8b-Instruct-bnb-4bit")
+
+
+def load_tokenizer(model_name: Optional[str] = None):
+    """
+    Только токенайзер (без весов) - его держат HTTP-воркеры, которые
+    обращаются к модели через процесс движка (engine.py).
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name or BASE_MODEL_NAME)
+    # Для батчей decoder-only модели паддинг должен быть слева
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def build_llama3_prompt(system_prompt: str, user_prompt: str) -> str:
+    """
+    Формат промпта для LLaMA 3 Instruct.
+    Важно: если нарушить формат, качество ответов часто падает.
+    Генерация собирает тот же промпт сразу из id токенов (Llama3PromptTemplate).
+    """
+    return (
+        f"<|start_header_id|>system<|end_header_id|>\n{system_prompt}<|eot_id|>"
+        f"<|start_header_id|>user<|end_header_id|>\n{user_prompt}<|eot_id|>"
+        f"<|start_header_id|>assistant<|end_header_id|>\n"
+    )
+
+
+def clean_llama3_output(decoded: str) -> str:
+    """
+    Чистим ответ: убираем служебные токены и оставляем только текст ассистента.
+    """
+    assistant_prefix = "<|start_header_id|>assistant<|end_header_id|>\n"
+    if assistant_prefix in decoded:
+        decoded = decoded.split(assistant_prefix)[-1]
+    return decoded.replace("<|eot_id|>", "").strip()
+
+
+class Llama3PromptTemplate:
+    """
+    Сборка промпта LLaMA 3 Instruct на уровне id токенов.
+
+    Служебные заголовки токенизируются один раз при создании шаблона, системный
+    промпт кэшируется, а на каждый запрос токенизируется только текст пользователя.
+    Текст пользователя токенизируется с split_special_tokens=True: строка
+    "<|eot_id|>" внутри вопроса остаётся обычным текстом и не ломает разметку.
+    Перевод строки после заголовка токенизируется вместе с текстом: у LLaMA 3
+    "\n\n" - один токен, и текст, начинающийся с "\n", иначе разошёлся бы со строкой.
+    Для обычного текста результат совпадает с tokenizer(build_llama3_prompt(...)).
+
+    Быстрый токенайзер HF нельзя вызывать из нескольких потоков одновременно
+    ("Already borrowed"), поэтому обращения к нему идут под общей блокировкой:
+    шаблоном пользуются и HTTP-потоки, и поток планировщика.
+    """
+
+    SYSTEM_CACHE_SIZE = 64
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._lock = threading.RLock()
+        # Токены, которые токенайзер сам добавляет в начало (для LLaMA 3 - <|begin_of_text|>)
+        self.prefix_ids = tokenizer("")["input_ids"]
+        self.system_header_ids = self._encode_markup("<|start_header_id|>system<|end_header_id|>")
+        self.user_header_ids = self._encode_markup("<|eot_id|><|start_header_id|>user<|end_header_id|>")
+        self.assistant_header_ids = self._encode_markup("<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n")
+        self._system_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+
+    def _encode_markup(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def encode_texts(self, texts: List[str]) -> List[List[int]]:
+        """Пакетная токенизация пользовательского текста (без служебных токенов)."""
+        if not texts:
+            return []
+        with self._lock:
+            return self.tokenizer(list(texts), add_special_tokens=False, split_special_tokens=True)["input_ids"]
+
+    def decode_batch(self, sequences: List[List[int]]) -> List[str]:
+        with self._lock:
+            return self.tokenizer.batch_decode(sequences, skip_special_tokens=True)
+
+    def _content_ids(self, texts: List[str]) -> List[List[int]]:
+        """Текст после заголовка - вместе с переводом строки, которым заголовок заканчивается."""
+        return self.encode_texts(["\n" + text for text in texts])
+
+    def system_ids(self, system_prompt: str) -> List[int]:
+        key = str(system_prompt)
+        with self._lock:
+            ids = self._system_cache.get(key)
+            if ids is None:
+                ids = self._content_ids([key])[0]
+                self._system_cache[key] = ids
+                if len(self._system_cache) > self.SYSTEM_CACHE_SIZE:
+                    self._system_cache.popitem(last=False)
+            else:
+                self._system_cache.move_to_end(key)
+            return ids
+
+    def build(self, system_ids: List[int], user_ids: List[int]) -> List[int]:
+        """system_ids и user_ids - с переводом строки в начале (system_ids(), _content_ids())."""
+        return (
+            self.prefix_ids
+            + self.system_header_ids + system_ids
+            + self.user_header_ids + user_ids
+            + self.assistant_header_ids
+        )
+
+    def overhead(self, system_prompt: str) -> int:
+        """
+        Сколько токенов промпта приходится на всё, кроме текста пользователя
+        (для текста, начинающегося с перевода строки, на один токен меньше).
+        """
+        return len(self.build(self.system_ids(system_prompt), self._content_ids([""])[0]))
+
+    def encode_batch(self, system_prompt, questions: List[str]) -> List[List[int]]:
+        """system_prompt - одна строка на весь батч или список, по строке на вопрос."""
+        if isinstance(system_prompt, list):
+            system_ids = [self.system_ids(sp) for sp in system_prompt]
+        else:
+            system_ids = [self.system_ids(system_prompt)] * len(questions)
+        return [self.build(sys_ids, user_ids) for sys_ids, user_ids in zip(system_ids, self._content_ids(questions))]
+
+
+_TEMPLATE_LOCK = threading.Lock()
+
+
+def get_prompt_template(tokenizer) -> Llama3PromptTemplate:
+    """Шаблон создаётся один раз на токенайзер (и одна блокировка токенайзера на все потоки)."""
+    with _TEMPLATE_LOCK:
+        return _prompt_template(tokenizer)
+
+
+@lru_cache(maxsize=4)
+def _prompt_template(tokenizer) -> Llama3PromptTemplate:
+    return Llama3PromptTemplate(tokenizer)
+
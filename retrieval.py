@@ -0,0 +1,322 @@
+import os
+import re
+import json
+import math
+import fcntl
+import time
+import logging
+import hashlib
+import threading
+from collections import Counter as TermCounter, defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from dotenv import load_dotenv
+from prometheus_client import Gauge, Histogram
+
+load_dotenv()
+
+# Каталог базы знаний (.md/.txt: тарифы, курсы, FAQ). Нет каталога - поиск выключен
+KNOWLEDGE_DIR = os.getenv("KNOWLEDGE_DIR", "./knowledge")
+# Куда сохранять индекс (векторы читаются через np.load(mmap_mode="r"))
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "./.cache/retrieval")
+# Модель эмбеддингов sentence-transformers (считается в процессе движка); пусто или пакет не установлен - BM25
+RETRIEVAL_EMBED_MODEL = os.getenv("RETRIEVAL_EMBED_MODEL", "")
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# Бюджет токенов на вставляемые в промпт фрагменты
+RETRIEVAL_MAX_TOKENS = int(os.getenv("RETRIEVAL_MAX_TOKENS", "800"))
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "800"))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "100"))
+
+KNOWLEDGE_EXTENSIONS = (".md", ".txt")
+CONTEXT_HEADER = "Справочная информация (используй её при ответе):"
+
+logger = logging.getLogger("uii-llm-api")
+
+LLM_RETRIEVAL_INDEX_BUILD_SECONDS = Gauge(
+    "llm_retrieval_index_build_seconds", "Время последней сборки/загрузки индекса базы знаний")
+LLM_RETRIEVAL_INDEX_PASSAGES = Gauge("llm_retrieval_index_passages", "Количество фрагментов в индексе базы знаний")
+LLM_RETRIEVAL_SEARCH_LATENCY = Histogram(
+    "llm_retrieval_search_seconds",
+    "Время поиска фрагментов для одного вопроса",
+    buckets=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1),
+)
+LLM_RETRIEVAL_CONTEXT_TOKENS = Histogram(
+    "llm_retrieval_context_tokens",
+    "Токены найденных фрагментов, вставленных в промпт",
+    buckets=(0,50,100,200,400,800,1600,3200),
+)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+@dataclass
+class Passage:
+    source: str
+    text: str
+
+
+def _tokenize_words(text: str) -> List[str]:
+    return [w.lower() for w in _WORD_RE.findall(text)]
+
+
+def chunk_text(text: str, max_chars: int = RETRIEVAL_CHUNK_CHARS, overlap: int = RETRIEVAL_CHUNK_OVERLAP) -> List[str]:
+    """
+    Режет документ на фрагменты до max_chars символов по границам абзацев.
+    Абзац длиннее max_chars режется окном с перекрытием overlap.
+    """
+    chunks: List[str] = []
+    current = ""
+    for paragraph in (p.strip() for p in re.split(r"\n\s*\n", text)):
+        if not paragraph:
+            continue
+        if len(paragraph) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(max_chars - overlap, 1)
+            chunks.extend(paragraph[i:i + max_chars] for i in range(0, len(paragraph), step))
+            continue
+        if current and len(current) + 2 + len(paragraph) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BM25:
+    """Классический BM25 поверх инвертированного индекса (без внешних зависимостей)."""
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[tuple]] = defaultdict(list)
+        lengths = []
+        for doc_id, text in enumerate(documents):
+            terms = TermCounter(_tokenize_words(text))
+            lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings[term].append((doc_id, tf))
+        self.doc_len = np.asarray(lengths, dtype=np.float32)
+        self.avg_len = float(self.doc_len.mean()) if len(lengths) else 0.0
+        n = len(lengths)
+        self.idf = {
+            term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len / max(self.avg_len, 1e-6))
+        for term in set(_tokenize_words(query)):
+            for doc_id, tf in self.postings.get(term, ()):
+                scores[doc_id] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm[doc_id])
+        return scores
+
+
+class KnowledgeIndex:
+    """
+    Индекс фрагментов базы знаний.
+
+    С моделью эмбеддингов - косинусная близость по нормированным векторам,
+    которые лежат в .npy и читаются через mmap (индекс не держится в куче процесса
+    и переживает перезапуск, если файлы базы не менялись). Без модели - BM25.
+    """
+
+    def __init__(self, passages: List[Passage], vectors: Optional[np.ndarray] = None, embed_fn=None):
+        self.passages = passages
+        self.vectors = vectors
+        self.embed_fn = embed_fn
+        self.bm25 = BM25([p.text for p in passages]) if vectors is None else None
+
+    @property
+    def backend(self) -> str:
+        return "vector" if self.vectors is not None else "bm25"
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> List[Passage]:
+        if not self.passages or top_k <= 0:
+            return []
+        if self.vectors is not None:
+            scores = np.asarray(self.vectors @ self.embed_fn([query])[0])
+        else:
+            scores = self.bm25.scores(query)
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        # Для BM25 нулевой score - ни одного общего слова с вопросом
+        return [self.passages[i] for i in best if self.vectors is not None or scores[i] > 0]
+
+
+def _knowledge_files(root: str) -> List[str]:
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        files.extend(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(KNOWLEDGE_EXTENSIONS))
+    return sorted(files)
+
+
+def _fingerprint(files: List[str], embed_model: str) -> str:
+    h = hashlib.sha256()
+    h.update(f"{embed_model}|{RETRIEVAL_CHUNK_CHARS}|{RETRIEVAL_CHUNK_OVERLAP}".encode())
+    for path in files:
+        st = os.stat(path)
+        h.update(f"|{path}|{st.st_size}|{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def _load_or_build(files: List[str], knowledge_dir: str, index_dir: str, fingerprint: str, embed_fn):
+    """Вызывается под блокировкой каталога индекса. Возвращает (passages, vectors, из кэша ли)."""
+    meta_path = os.path.join(index_dir, "meta.json")
+    vectors_path = os.path.join(index_dir, "vectors.npy")
+
+    meta = None
+    if os.path.isfile(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("fingerprint") != fingerprint:
+            meta = None
+    if meta is not None:
+        passages = [Passage(**p) for p in meta["passages"]]
+        vectors = np.load(vectors_path, mmap_mode="r") if embed_fn is not None and passages else None
+        return passages, vectors, True
+
+    passages = []
+    for path in files:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        source = os.path.relpath(path, knowledge_dir)
+        passages.extend(Passage(source=source, text=chunk) for chunk in chunk_text(text))
+    vectors = None
+    # Пишем во временный файл (свой у каждого процесса) и переименовываем,
+    # чтобы не подсунуть mmap и читателям полузаписанный индекс
+    tmp_suffix = f".{os.getpid()}.tmp"
+    if embed_fn is not None and passages:
+        with open(vectors_path + tmp_suffix, "wb") as f:
+            np.save(f, embed_fn([p.text for p in passages]))
+        os.replace(vectors_path + tmp_suffix, vectors_path)
+        vectors = np.load(vectors_path, mmap_mode="r")
+    with open(meta_path + tmp_suffix, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "passages": [p.__dict__ for p in passages]}, f, ensure_ascii=False)
+    os.replace(meta_path + tmp_suffix, meta_path)
+    return passages, vectors, False
+
+
+def build_index(
+    knowledge_dir: str = KNOWLEDGE_DIR,
+    index_dir: str = RETRIEVAL_INDEX_DIR,
+    embed_model: str = RETRIEVAL_EMBED_MODEL,
+    embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+) -> Optional[KnowledgeIndex]:
+    """
+    Собирает индекс по каталогу базы знаний или загружает сохранённый,
+    если файлы базы и настройки не менялись. Нет каталога - None.
+    embed_fn считает векторы моделью embed_model - это энкодер процесса движка
+    (InferenceEngine.retrieval_embed), а не своя копия модели в каждом HTTP-воркере.
+    Без embed_fn или если энкодер недоступен - BM25.
+    """
+    if not knowledge_dir or not os.path.isdir(knowledge_dir):
+        logger.warning("RETRIEVAL: каталог базы знаний %r не найден, поиск выключен", knowledge_dir)
+        return None
+    t0 = time.time()
+    files = _knowledge_files(knowledge_dir)
+    embed_fn = embed_fn if embed_model else None
+    os.makedirs(index_dir, exist_ok=True)
+    # Индекс могут собирать несколько процессов сразу (HTTP-воркеры при старте):
+    # собирает первый, остальные ждут блокировку и читают уже готовый кэш
+    with open(os.path.join(index_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            passages, vectors, cached = _load_or_build(
+                files, knowledge_dir, index_dir, _fingerprint(files, embed_model if embed_fn is not None else ""),
+                embed_fn,
+            )
+        except Exception as e:
+            if embed_fn is None:
+                raise
+            # Нет sentence-transformers в процессе движка, модель не загрузилась, движок недоступен
+            logger.error("RETRIEVAL: эмбеддинги не посчитаны (%s), используется BM25", str(e))
+            embed_fn = None
+            passages, vectors, cached = _load_or_build(
+                files, knowledge_dir, index_dir, _fingerprint(files, ""), None,
+            )
+
+    index = KnowledgeIndex(passages, vectors=vectors, embed_fn=embed_fn)
+    elapsed = time.time() - t0
+    LLM_RETRIEVAL_INDEX_BUILD_SECONDS.set(elapsed)
+    LLM_RETRIEVAL_INDEX_PASSAGES.set(len(passages))
+    logger.warning("RETRIEVAL: индекс готов: %d фрагментов из %d файлов, backend=%s, %.2fs (%s)",
+                   len(passages), len(files), index.backend, elapsed, "cache" if cached else "built")
+    return index
+
+
+class Retriever:
+    """
+    Подбор фрагментов базы знаний под вопрос с бюджетом по токенам.
+    Индекс можно пересобрать на лету (reindex), поиск в это время идёт по старому.
+    """
+
+    def __init__(
+        self,
+        top_k: int = RETRIEVAL_TOP_K,
+        max_tokens: int = RETRIEVAL_MAX_TOKENS,
+        embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None,
+    ):
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+        # Энкодер для RETRIEVAL_EMBED_MODEL (см. build_index)
+        self.embed_fn = embed_fn
+        self.index: Optional[KnowledgeIndex] = None
+        self._reindex_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.index is not None
+
+    def reindex(self) -> Optional[KnowledgeIndex]:
+        with self._reindex_lock:
+            self.index = build_index(embed_fn=self.embed_fn)
+        return self.index
+
+    def retrieve(self, question: str, count_tokens: Callable[[List[str]], List[int]]) -> List[Passage]:
+        """
+        Топ-k фрагментов по вопросу; берём по порядку релевантности,
+        пока суммарно укладываемся в max_tokens.
+        """
+        index = self.index
+        if index is None:
+            return []
+        with LLM_RETRIEVAL_SEARCH_LATENCY.time():
+            found = index.search(question, self.top_k)
+        selected, used = [], 0
+        for passage, n_tokens in zip(found, count_tokens([p.text for p in found]) if found else []):
+            if used + n_tokens > self.max_tokens:
+                continue
+            selected.append(passage)
+            used += n_tokens
+        LLM_RETRIEVAL_CONTEXT_TOKENS.observe(used)
+        return selected
+
+
+def compose_system_prompt(system_prompt: str, passages: List[Passage]) -> str:
+    """Базовый системный промпт + найденные фрагменты."""
+    if not passages:
+        return system_prompt
+    context = "\n\n".join(f"[{p.source}]\n{p.text}" for p in passages)
+    return f"{system_prompt}\n\n{CONTEXT_HEADER}\n{context}"
+
+
+def engine_embedder(engine) -> Optional[Callable[[List[str]], np.ndarray]]:
+    """embed_fn для RETRIEVAL_EMBED_MODEL через движок (InferenceEngine или EngineClient)."""
+    if not RETRIEVAL_EMBED_MODEL:
+        return None
+    return lambda texts: engine.retrieval_embed(texts, RETRIEVAL_EMBED_MODEL).result()
+
+
+if __name__ == "__main__":
+    # python retrieval.py - собрать индекс заранее (serve.py делает это до запуска HTTP-воркеров,
+    # когда движок уже слушает ENGINE_SOCKET: векторы считает его энкодер)
+    from engine_client import ENGINE_SOCKET, EngineClient
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    build_index(embed_fn=engine_embedder(EngineClient(ENGINE_SOCKET)) if ENGINE_SOCKET else None)
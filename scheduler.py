@@ -0,0 +1,206 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Hashable, List, Optional
+
+logger = logging.getLogger("uii-llm-api")
+
+# Сколько совместимых запросов из очереди можно объединить в один вызов модели
+SCHEDULER_MAX_BATCH_SIZE = int(os.getenv("SCHEDULER_MAX_BATCH_SIZE", "4"))
+
+
+class DeadlineExceeded(Exception):
+    """Дедлайн запроса истёк, пока он стоял в очереди (генерация не запускалась)."""
+
+
+@dataclass(eq=False)
+class Job:
+    # Одиночная задача: fn() -> результат
+    fn: Optional[Callable[[], Any]] = None
+    # Батчируемая задача: batch_fn([payload, ...]) -> [результат, ...] в том же порядке
+    payload: Any = None
+    batch_fn: Optional[Callable[[List[Any]], List[Any]]] = None
+    batch_key: Hashable = None
+    # Абсолютный дедлайн в шкале time.monotonic(); None - без ограничения
+    deadline: Optional[float] = None
+    # Оценка, сколько секунд батч будет занят этой задачей; None - неизвестно
+    cost: Optional[float] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    future: Future = field(default_factory=Future)
+
+    def expired(self, now: Optional[float] = None) -> bool:
+        if self.deadline is None:
+            return False
+        return (now if now is not None else time.monotonic()) >= self.deadline
+
+    def batches_with(self, other: "Job") -> bool:
+        # ==, а не is: self.method при каждом обращении - новый объект bound-метода,
+        # равны они, если это тот же метод того же объекта
+        return (
+            self.batch_fn is not None
+            and other.batch_fn == self.batch_fn
+            and other.batch_key == self.batch_key
+        )
+
+
+def fits_deadlines(jobs: List[Job], now: Optional[float] = None) -> bool:
+    """
+    Успеют ли задачи с дедлайном, если выполнять их одним батчем.
+
+    Строка с дедлайном перестаёт декодироваться по дедлайну, но её результат
+    отдаётся только вместе со всем батчем - когда закончит самая долгая строка.
+    Поэтому батч не должен длиться дольше самого раннего дедлайна: длительность
+    батча - максимум из cost задач (для задачи с дедлайном - не дольше её дедлайна).
+    Если у кого-то в батче с дедлайнами cost неизвестен, гарантировать нельзя.
+    """
+    deadlines = [j.deadline for j in jobs if j.deadline is not None]
+    if not deadlines or len(jobs) < 2:
+        return True
+    if any(j.cost is None for j in jobs):
+        return False
+    now = now if now is not None else time.monotonic()
+    duration = max(
+        min(j.cost, max(j.deadline - now, 0.0)) if j.deadline is not None else j.cost for j in jobs
+    )
+    return now + duration <= min(deadlines)
+
+
+class GenerationScheduler:
+    """
+    Очередь задач к модели с одним рабочим потоком.
+
+    GPU одна, поэтому вызовы модели выполняются строго по очереди, а HTTP-потоки
+    FastAPI только ждут результат через Future. Батчируемые задачи с одинаковыми
+    batch_fn и batch_key (например, одинаковой temperature) забираются из очереди
+    вместе, до max_batch_size штук за раз.
+
+    Задачи, дедлайн которых истёк за время ожидания в очереди, не запускаются:
+    их Future завершается исключением DeadlineExceeded. Задача с дедлайном
+    не попадает в батч, который по оценке (Job.cost) продлится дольше её
+    дедлайна (см. fits_deadlines) - она уходит следующим батчем.
+    """
+
+    def __init__(
+        self,
+        name: str = "llm-scheduler",
+        max_batch_size: int = SCHEDULER_MAX_BATCH_SIZE,
+        on_wait: Optional[Callable[[float], None]] = None,
+    ):
+        self.name = name
+        self.max_batch_size = max(1, max_batch_size)
+        # Колбэк для метрики: время ожидания задачи в очереди (сек)
+        self.on_wait = on_wait
+        self._jobs: Deque[Job] = deque()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable[[], Any], deadline: Optional[float] = None) -> Future:
+        return self._put(Job(fn=fn, deadline=deadline))
+
+    def submit_batch_item(
+        self,
+        payload: Any,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        batch_key: Hashable = None,
+        deadline: Optional[float] = None,
+        cost: Optional[float] = None,
+    ) -> Future:
+        """
+        Поставить в очередь элемент, который можно выполнить в батче с другими.
+        batch_fn может вернуть вместо результата исключение - оно уйдёт только
+        в Future этого элемента. cost - оценка длительности в секундах
+        (нужна, чтобы батчировать задачи с дедлайном).
+        """
+        return self._put(Job(
+            payload=payload, batch_fn=batch_fn, batch_key=batch_key, deadline=deadline, cost=cost,
+        ))
+
+    def depth(self) -> int:
+        """Количество задач, ожидающих выполнения."""
+        with self._cond:
+            return len(self._jobs)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждёт, пока очередь опустеет и текущий батч закончится.
+        Возвращает False, если за timeout секунд не успели.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._jobs and not self._running, timeout)
+
+    def _put(self, job: Job) -> Future:
+        with self._cond:
+            self._jobs.append(job)
+            self._cond.notify()
+        return job.future
+
+    def _next_batch(self) -> List[Job]:
+        with self._cond:
+            while not self._jobs:
+                self._cond.wait()
+            head = self._jobs.popleft()
+            batch = [head]
+            if head.batch_fn is not None:
+                now = time.monotonic()
+                for job in list(self._jobs):
+                    if len(batch) >= self.max_batch_size:
+                        break
+                    if head.batches_with(job) and fits_deadlines(batch + [job], now):
+                        self._jobs.remove(job)
+                        batch.append(job)
+            self._running = len(batch)
+            return batch
+
+    def _worker(self) -> None:
+        while True:
+            jobs = self._next_batch()
+            try:
+                self._run(jobs)
+            finally:
+                with self._cond:
+                    self._running = 0
+                    self._cond.notify_all()
+
+    def _run(self, jobs: List[Job]) -> None:
+        now = time.monotonic()
+        ready = []
+        for job in jobs:
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            if job.expired(now):
+                job.future.set_exception(
+                    DeadlineExceeded(f"deadline expired after {now - job.enqueued_at:.3f}s in queue")
+                )
+                continue
+            if self.on_wait is not None:
+                self.on_wait(now - job.enqueued_at)
+            ready.append(job)
+        if not ready:
+            return
+
+        try:
+            if ready[0].batch_fn is None:
+                results = [ready[0].fn()]
+            else:
+                results = ready[0].batch_fn([job.payload for job in ready])
+        except Exception as e:
+            for job in ready:
+                job.future.set_exception(e)
+            return
+
+        for job, result in zip(ready, results):
+            if isinstance(result, BaseException):
+                job.future.set_exception(result)
+            else:
+                job.future.set_result(result)
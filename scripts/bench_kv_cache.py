@@ -0,0 +1,198 @@
+"""
+Бенчмарк квантованного KV-кэша: память и качество ответов в сравнении с fp16.
+
+Для каждого режима (fp16, int8, int4) один и тот же батч вопросов генерируется
+жадно (temperature=0) через model.generate_batch - тот же путь, что и в сервисе.
+Сравниваются:
+- память KV-кэша: реальный размер тензоров кэша после генерации, байт на токен
+  и сколько последовательностей длиной --context-len поместится в --kv-budget-gb;
+- пик памяти GPU во время генерации (если есть CUDA);
+- скорость: токенов в секунду;
+- качество: доля ответов, совпавших с fp16 дословно, и средняя доля токенов
+  до первого расхождения с fp16 (жадное декодирование детерминировано, так что
+  расхождение - эффект квантования).
+
+Запуск (из корня проекта):
+  python scripts/bench_kv_cache.py --modes fp16,int8,int4 --batch-size 4 --max-new-tokens 128
+
+fp16 прогоняется всегда первым, даже если его нет в --modes: с ним сравниваются
+память и качество остальных режимов.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+from transformers import DynamicCache
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import (  # noqa: E402
+    KV_CACHE_QUANT_BACKEND, KV_CACHE_QUANT_GROUP_SIZE, KV_CACHE_RESIDUAL_LEN,
+    GenerationInput, KVCacheQuantization, _left_pad, generate_batch, get_prompt_template,
+    load_model_and_tokenizer,
+)
+
+SYSTEM_PROMPT = (
+    "Ты - менеджер поддержки Университета Искусственного интеллекта. "
+    "Отвечай кратко и по делу, на русском языке."
+)
+
+QUESTIONS = [
+    "Чем тариф \"Базовый\" отличается от \"Основного\"?",
+    "Сколько длится обучение и можно ли учиться в своём темпе?",
+    "Есть ли рассрочка и как её оформить?",
+    "Что делать, если не получается запустить ноутбук с домашним заданием?",
+    "Выдаёте ли вы сертификат после окончания курса?",
+    "Можно ли перейти на другой тариф во время обучения?",
+    "Какие знания нужны, чтобы начать обучение с нуля?",
+    "Как связаться с куратором и как быстро он отвечает?",
+]
+
+
+def _tensors_nbytes(obj) -> int:
+    """Размер всех тензоров внутри obj (кортежи/словари метаданных hqq, QTensor quanto)."""
+    if isinstance(obj, torch.Tensor):
+        flatten = getattr(obj, "__tensor_flatten__", None)
+        if flatten is not None and type(obj) is not torch.Tensor:
+            names, _ = flatten()
+            return sum(_tensors_nbytes(getattr(obj, name)) for name in names)
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(_tensors_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_tensors_nbytes(v) for v in obj)
+    return 0
+
+
+def kv_cache_nbytes(cache) -> int:
+    total = 0
+    for layer in cache.layers:
+        for name in ("keys", "values", "_quantized_keys", "_quantized_values"):
+            total += _tensors_nbytes(getattr(layer, name, None))
+    return total
+
+
+def measure_cache(model, tokenizer, prompt_ids, max_new_tokens: int, kv_quant) -> dict:
+    """Отдельный прогон model.generate, чтобы после него посмотреть на сам объект кэша."""
+    inputs = _left_pad(prompt_ids, tokenizer.pad_token_id, device=model.device)
+    cache = kv_quant.new_cache(model.config) if kv_quant is not None else DynamicCache()
+    with torch.no_grad():
+        model.generate(
+            **inputs,
+            past_key_values=cache,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            temperature=None,
+            top_p=None,
+            top_k=None,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    rows = inputs["input_ids"].shape[0]
+    tokens = rows * cache.get_seq_length()
+    nbytes = kv_cache_nbytes(cache)
+    return {"cache_bytes": nbytes, "cache_tokens": tokens, "bytes_per_token": nbytes / max(tokens, 1)}
+
+
+def common_prefix(a, b) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="fp16,int8,int4", help="через запятую: fp16, int8, int4")
+    parser.add_argument("--backend", default=KV_CACHE_QUANT_BACKEND, help="hqq или quanto")
+    parser.add_argument("--residual-length", type=int, default=KV_CACHE_RESIDUAL_LEN)
+    parser.add_argument("--group-size", type=int, default=KV_CACHE_QUANT_GROUP_SIZE)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--context-len", type=int, default=4096, help="длина последовательности для оценки ёмкости")
+    parser.add_argument("--kv-budget-gb", type=float, default=None,
+                        help="память под KV-кэш; по умолчанию - свободная память GPU после загрузки модели")
+    parser.add_argument("--output", default=None, help="куда сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    model, tokenizer = load_model_and_tokenizer()
+    questions = (QUESTIONS * (args.batch_size // len(QUESTIONS) + 1))[: args.batch_size]
+    items = [GenerationInput(question=q, max_new_tokens=args.max_new_tokens, temperature=0.0) for q in questions]
+    prompt_ids = get_prompt_template(tokenizer).encode_batch(SYSTEM_PROMPT, questions)
+
+    budget = args.kv_budget_gb * 1024 ** 3 if args.kv_budget_gb else None
+    if budget is None and torch.cuda.is_available():
+        budget = torch.cuda.mem_get_info()[0]
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    modes = ["fp16"] + [m for m in modes if m != "fp16"]
+
+    results, reference = [], None
+    for mode in modes:
+        kv_quant = None
+        if mode != "fp16":
+            kv_quant = KVCacheQuantization(
+                mode, backend=args.backend, residual_length=args.residual_length, group_size=args.group_size,
+            )
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+
+        t0 = time.time()
+        completions = generate_batch(items, model=model, tokenizer=tokenizer,
+                                     system_prompt=SYSTEM_PROMPT, kv_quant=kv_quant)
+        elapsed = time.time() - t0
+        if kv_quant is not None and not kv_quant.enabled:
+            print(f"{mode}: квантованный кэш не заработал (см. лог выше), режим пропущен")
+            continue
+        peak = torch.cuda.max_memory_allocated() - base_memory if torch.cuda.is_available() else None
+
+        row = {"mode": mode, "seconds": elapsed,
+               "tokens_per_s": sum(c.completion_tokens for c in completions) / max(elapsed, 1e-9),
+               "peak_gpu_bytes": peak}
+        row.update(measure_cache(model, tokenizer, prompt_ids, args.max_new_tokens, kv_quant))
+        if budget:
+            row["sequences_in_budget"] = int(budget // (row["bytes_per_token"] * args.context_len))
+
+        texts = [c.text for c in completions]
+        tokens = get_prompt_template(tokenizer).encode_texts(texts)
+        if reference is None:
+            reference = (texts, tokens)
+        row["exact_match"] = sum(a == b for a, b in zip(texts, reference[0])) / len(texts)
+        row["prefix_agreement"] = sum(
+            common_prefix(t, r) / max(len(r), 1) for t, r in zip(tokens, reference[1])
+        ) / len(tokens)
+        row["sample"] = texts[0][:200]
+        results.append(row)
+
+    if not results:
+        print("Нет результатов: ни один режим не отработал")
+        return 1
+
+    fp16_bytes = results[0]["bytes_per_token"]
+    print(f"\nbatch={args.batch_size} max_new_tokens={args.max_new_tokens} backend={args.backend} "
+          f"residual={args.residual_length} group={args.group_size} (качество - относительно fp16)")
+    print(f"{'mode':<6} {'KV B/token':>11} {'vs fp16':>8} {'seqs@ctx':>9} {'peak GPU MB':>12} "
+          f"{'tok/s':>8} {'exact':>6} {'prefix':>7}")
+    for row in results:
+        peak = f"{row['peak_gpu_bytes'] / 2 ** 20:.0f}" if row["peak_gpu_bytes"] is not None else "-"
+        print(f"{row['mode']:<6} {row['bytes_per_token']:>11.0f} {row['bytes_per_token'] / fp16_bytes:>8.2f} "
+              f"{row.get('sequences_in_budget', '-'):>9} {peak:>12} {row['tokens_per_s']:>8.1f} "
+              f"{row['exact_match']:>6.2f} {row['prefix_agreement']:>7.2f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,116 @@
+"""
+Запуск сервиса в режиме "один процесс движка + N HTTP-воркеров".
+
+    python serve.py
+
+1) Стартует процесс движка (engine.py): он единственный загружает модель в GPU
+   и слушает Unix-сокет ENGINE_SOCKET.
+2) Пока движок грузит модель, собирается индекс базы знаний (python retrieval.py),
+   чтобы HTTP-воркеры не собирали его одновременно, а только читали готовый.
+   Векторы (RETRIEVAL_EMBED_MODEL) считает энкодер движка - сборка ждёт его сокет.
+3) Стартует uvicorn с HTTP_WORKERS воркерами: каждый импортирует app.py,
+   но вместо модели подключается к движку (разбор HTTP/JSON, валидация,
+   токенизация и поиск по базе знаний идут параллельно на разных ядрах CPU).
+   Воркерам нужен только токенайзер, поэтому они запускаются с USE_TORCH=0:
+   transformers не импортирует torch, и воркер не держит в памяти ни torch, ни CUDA.
+
+SIGTERM/SIGINT: сначала останавливается uvicorn (дожидается текущих запросов),
+затем движок (дожидается очереди генераций). Если один из процессов упал,
+останавливается и второй - контейнер перезапустится целиком.
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import logging
+import subprocess
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8000"))
+# Сколько процессов uvicorn принимают HTTP-запросы (модель при этом одна)
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "2"))
+ENGINE_SOCKET = os.getenv("ENGINE_SOCKET", "") or "/tmp/uii-llm-engine.sock"
+# Каталог для метрик prometheus_client из нескольких воркеров (multiprocess mode)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "") or "/tmp/uii-llm-prometheus"
+GRACEFUL_SHUTDOWN_TIMEOUT_S = int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT_S", "60"))
+SHUTDOWN_DRAIN_TIMEOUT_S = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT_S", "60"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL, logging.WARNING),
+    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+)
+logger = logging.getLogger("uii-llm-api")
+
+
+def _stop(process: subprocess.Popen, timeout: float) -> None:
+    if process.poll() is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.error("SERVE: pid %d did not stop in %.0fs, killing", process.pid, timeout)
+        process.kill()
+        process.wait()
+
+
+def main() -> int:
+    env = dict(os.environ, ENGINE_SOCKET=ENGINE_SOCKET)
+    if HTTP_WORKERS > 1:
+        # Метрики воркеров складываются в общий каталог, /metrics любого воркера отдаёт сумму.
+        # Каталог очищается при каждом запуске, иначе счётчики прошлых процессов попадут в сумму
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR)
+        http_env = dict(env, PROMETHEUS_MULTIPROC_DIR=PROMETHEUS_MULTIPROC_DIR)
+    else:
+        http_env = dict(env)
+    http_env["USE_TORCH"] = "0"
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    if os.path.exists(ENGINE_SOCKET):
+        # Сокет от предыдущего запуска - иначе его появление ниже ничего не значит
+        os.unlink(ENGINE_SOCKET)
+    engine = subprocess.Popen([sys.executable, "engine.py"], env=env)
+    # Движок открывает сокет до загрузки модели, поэтому ждать недолго
+    while not os.path.exists(ENGINE_SOCKET) and engine.poll() is None and not stopping:
+        time.sleep(0.1)
+    # Индекс базы знаний собирается один раз до старта воркеров - воркеры только читают его из кэша
+    if subprocess.run([sys.executable, "retrieval.py"], env=http_env).returncode != 0:
+        logger.error("SERVE: retrieval index build failed, workers will retry on startup")
+    http = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--host", HTTP_HOST,
+            "--port", str(HTTP_PORT),
+            "--workers", str(HTTP_WORKERS),
+            "--timeout-graceful-shutdown", str(GRACEFUL_SHUTDOWN_TIMEOUT_S),
+        ],
+        env=http_env,
+    )
+    logger.warning("SERVE: engine pid=%d, uvicorn pid=%d (%d workers), socket=%s",
+                   engine.pid, http.pid, HTTP_WORKERS, ENGINE_SOCKET)
+
+    while not stopping and engine.poll() is None and http.poll() is None:
+        time.sleep(0.5)
+
+    if not stopping:
+        logger.error("SERVE: %s exited with code %s, stopping service",
+                     "engine" if engine.poll() is not None else "uvicorn",
+                     engine.returncode if engine.poll() is not None else http.returncode)
+    # Порядок важен: HTTP-воркеры доотвечают на текущие запросы, пока движок ещё работает
+    _stop(http, GRACEFUL_SHUTDOWN_TIMEOUT_S + 10)
+    _stop(engine, SHUTDOWN_DRAIN_TIMEOUT_S + 10)
+    return 0 if stopping else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
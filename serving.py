@@ -0,0 +1,219 @@
+import gc
+import os
+import time
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+from prometheus_client import Counter
+
+from adapters import AdapterManager
+from model import (
+    BASE_MODEL_NAME, STATIC_KV_CACHE, GenerationInput, KVCacheQuantization, StaticDecodeCache,
+    generate_batch, load_model_and_tokenizer,
+)
+from scheduler import SCHEDULER_MAX_BATCH_SIZE
+
+try:
+    import torch
+except Exception:
+    torch = None
+
+load_dotenv()
+
+# Стратегия перезагрузки модели по умолчанию:
+#   parallel - новая модель грузится рядом с текущей (нужна память под обе)
+#   drain    - дождаться обработки очереди, выгрузить текущую, загрузить новую
+RELOAD_STRATEGY = os.getenv("RELOAD_STRATEGY", "parallel").lower()
+RELOAD_STRATEGIES = ("parallel", "drain")
+
+logger = logging.getLogger("uii-llm-api")
+
+LLM_MODEL_RELOADS_TOTAL = Counter(
+    "llm_model_reloads_total", "Перезагрузки модели без остановки сервиса", ["strategy", "result"])
+
+
+@dataclass(eq=False)
+class ServingModel:
+    """Всё, что нужно для генерации одной моделью: веса, токенайзер, адаптеры, режимы KV-кэша."""
+    name: str
+    model: Any
+    tokenizer: Any
+    adapters: AdapterManager
+    static_decode: Optional[StaticDecodeCache] = None
+    kv_quant: Optional[KVCacheQuantization] = None
+    loaded_at: float = field(default_factory=time.time)
+
+    @property
+    def ready(self) -> bool:
+        return self.model is not None
+
+    def release(self) -> None:
+        """Отпускает веса модели (для стратегии drain, когда две модели не помещаются в память)."""
+        self.model = None
+        self.static_decode = None
+        self.adapters.attach(None)
+        _free_memory()
+
+
+def _free_memory() -> None:
+    gc.collect()
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def load_serving_model(model_name: Optional[str] = None, logger: Optional[logging.Logger] = None) -> ServingModel:
+    model_name = model_name or BASE_MODEL_NAME
+    # Настройка проверяется до загрузки весов, а не после минут ожидания
+    kv_quant = KVCacheQuantization.from_env()
+    model, tokenizer = load_model_and_tokenizer(logger=logger, model_name=model_name)
+    adapters = AdapterManager()
+    adapters.attach(model)
+    static_decode = None
+    if STATIC_KV_CACHE:
+        static_decode = StaticDecodeCache(model.config, max_batch_size=SCHEDULER_MAX_BATCH_SIZE)
+    if kv_quant is not None and static_decode is not None:
+        logger.warning("KV CACHE QUANT: %s cache is used only for batches that do not fit the static cache", kv_quant.mode)
+    return ServingModel(
+        name=model_name, model=model, tokenizer=tokenizer, adapters=adapters,
+        static_decode=static_decode, kv_quant=kv_quant,
+    )
+
+
+def warmup_serving_model(serving: ServingModel, system_prompt: str) -> None:
+    """
+    Прогрев перед приёмом трафика: короткая генерация, а в режиме статического
+    KV-кэша - выделение кэшей и компиляция декодирования для всех бакетов.
+    """
+    if serving.static_decode is not None:
+        try:
+            serving.static_decode.warmup(serving.model, serving.tokenizer, system_prompt)
+        except Exception as e:
+            serving.static_decode.disable(str(e))
+        if serving.static_decode.enabled and serving.kv_quant is None:
+            return
+    # Заодно проверяется квантованный KV-кэш (если батч не ушёл в статический):
+    # если бэкенд не работает, режим отключится до первых запросов
+    generate_batch(
+        [GenerationInput(question="warmup", max_new_tokens=2)],
+        model=serving.model,
+        tokenizer=serving.tokenizer,
+        system_prompt=system_prompt,
+        kv_quant=serving.kv_quant,
+    )
+
+
+class ModelReloader:
+    """
+    Перезагрузка модели без остановки сервиса.
+
+    current - модель, на которую уходят новые батчи. Планировщик берёт её в начале
+    каждого батча, поэтому уже идущая генерация доигрывает на старой модели,
+    а всё, что стартует после переключения, - на новой.
+
+    parallel: новая модель грузится в фоновом потоке рядом с текущей, прогревается
+    через очередь планировщика и подменяет текущую одним присваиванием.
+    drain: в очередь ставится задача перезагрузки; она выполняется после уже
+    поставленных запросов, выгружает старую модель и грузит новую. Запросы,
+    пришедшие в это время, ждут в очереди и выполняются уже на новой модели.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        system_prompt: str,
+        current: Optional[ServingModel] = None,
+        on_finish: Optional[Callable[[], None]] = None,
+    ):
+        self.scheduler = scheduler
+        self.system_prompt = system_prompt
+        self.current = current
+        # Колбэк по окончании перезагрузки (успешной или нет), например чтобы оповестить HTTP-воркеры
+        self.on_finish = on_finish
+        self._lock = threading.Lock()
+        self._state = {"in_progress": False, "strategy": None, "target": None,
+                       "started_at": None, "finished_at": None, "error": None}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._state["in_progress"]
+
+    def accepting(self) -> bool:
+        """Можно ли ставить запросы в очередь: модель есть или вот-вот появится."""
+        return (self.current is not None and self.current.ready) or self.in_progress
+
+    def status(self) -> dict:
+        with self._lock:
+            status = dict(self._state)
+        status["model"] = self.current.name if self.current is not None and self.current.ready else None
+        status["loaded_at"] = self.current.loaded_at if self.current is not None else None
+        return status
+
+    def start(self, model_name: Optional[str] = None, strategy: Optional[str] = None) -> bool:
+        """Запускает перезагрузку в фоне. False - перезагрузка уже идёт."""
+        strategy = strategy or RELOAD_STRATEGY
+        if strategy not in RELOAD_STRATEGIES:
+            raise ValueError(f"unknown reload strategy {strategy!r}, expected one of {RELOAD_STRATEGIES}")
+        target = model_name or (self.current.name if self.current is not None else BASE_MODEL_NAME)
+        with self._lock:
+            if self._state["in_progress"]:
+                return False
+            self._state.update(in_progress=True, strategy=strategy, target=target,
+                               started_at=time.time(), finished_at=None, error=None)
+        logger.warning("RELOAD: %s -> %s (strategy=%s)",
+                       self.current.name if self.current is not None else None, target, strategy)
+        if strategy == "parallel":
+            threading.Thread(target=self._reload_parallel, args=(target,), name="model-reload", daemon=True).start()
+        else:
+            self.scheduler.submit(lambda: self._reload_drain(target))
+        return True
+
+    def _finish(self, strategy: str, error: Optional[Exception] = None) -> None:
+        with self._lock:
+            self._state.update(in_progress=False, finished_at=time.time(),
+                               error=str(error) if error is not None else None)
+        LLM_MODEL_RELOADS_TOTAL.labels(strategy=strategy, result="error" if error else "ok").inc()
+        if error is not None:
+            logger.error("RELOAD ERROR: %s", str(error))
+        else:
+            logger.warning("RELOAD: serving %s", self.current.name)
+        if self.on_finish is not None:
+            self.on_finish()
+
+    def _reload_parallel(self, target: str) -> None:
+        try:
+            serving = load_serving_model(target, logger=logger)
+            # Прогрев идёт через очередь, чтобы не делить GPU с текущими генерациями
+            self.scheduler.submit(lambda: warmup_serving_model(serving, self.system_prompt)).result()
+        except Exception as e:
+            self._finish("parallel", e)
+            return
+        self.current = serving
+        # Старая модель освобождается после батча, который мог её ещё использовать
+        self.scheduler.submit(_free_memory)
+        self._finish("parallel")
+
+    def _reload_drain(self, target: str) -> None:
+        # Выполняется в потоке планировщика: пока идёт перезагрузка, очередь стоит
+        previous = self.current
+        previous_name = previous.name if previous is not None else None
+        if previous is not None:
+            previous.release()
+        try:
+            serving = load_serving_model(target, logger=logger)
+            warmup_serving_model(serving, self.system_prompt)
+        except Exception as e:
+            if previous_name is not None:
+                logger.error("RELOAD ERROR: %s, restoring %s", str(e), previous_name)
+                try:
+                    restored = load_serving_model(previous_name, logger=logger)
+                    warmup_serving_model(restored, self.system_prompt)
+                    self.current = restored
+                except Exception as restore_error:
+                    logger.error("RELOAD ERROR: restore failed: %s", str(restore_error))
+            self._finish("drain", e)
+            return
+        self.current = serving
+        self._finish("drain")
@@ -0,0 +1,115 @@
+import os
+import time
+import logging
+import resource
+import threading
+from typing import Optional
+
+from dotenv import load_dotenv
+from prometheus_client import Gauge
+
+try:
+    import torch
+except Exception:
+    torch = None
+
+load_dotenv()
+
+# Период опроса ресурсов процесса, сек (0 - телеметрия выключена)
+TELEMETRY_INTERVAL_S = float(os.getenv("TELEMETRY_INTERVAL_S", "5"))
+
+logger = logging.getLogger("uii-llm-api")
+
+LLM_GPU_MEMORY_ALLOCATED = Gauge(
+    "llm_gpu_memory_allocated_bytes", "torch.cuda: память, занятая тензорами процесса", ["device"])
+LLM_GPU_MEMORY_RESERVED = Gauge(
+    "llm_gpu_memory_reserved_bytes", "torch.cuda: память, зарезервированная кэширующим аллокатором", ["device"])
+LLM_GPU_MEMORY_PEAK = Gauge(
+    "llm_gpu_memory_peak_allocated_bytes", "torch.cuda: пик занятой тензорами памяти с момента старта", ["device"])
+LLM_GPU_MEMORY_FREE = Gauge(
+    "llm_gpu_memory_free_bytes", "Свободная память GPU по данным драйвера (запас под новые запросы)", ["device"])
+LLM_GPU_MEMORY_TOTAL = Gauge("llm_gpu_memory_total_bytes", "Общий объём памяти GPU", ["device"])
+LLM_GPU_ALLOC_RETRIES = Gauge(
+    "llm_gpu_allocator_retries", "torch.cuda: сколько раз аллокатор сбрасывал кэш, чтобы выделить память", ["device"])
+LLM_GPU_OOMS = Gauge("llm_gpu_allocator_ooms", "torch.cuda: количество OOM в аллокаторе", ["device"])
+
+LLM_KV_CACHE_BYTES = Gauge("llm_kv_cache_bytes", "Оценка памяти KV-кэша текущего батча генерации")
+LLM_ACTIVE_SEQUENCES = Gauge("llm_active_sequences", "Количество последовательностей, которые сейчас декодируются")
+
+LLM_PROCESS_RSS = Gauge("llm_process_rss_bytes", "Resident memory процесса (режим без GPU)")
+LLM_PROCESS_CPU_SECONDS = Gauge("llm_process_cpu_seconds", "Процессорное время процесса, user+system (режим без GPU)")
+
+
+def _read_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
+
+class ResourceSampler:
+    """
+    Фоновый опрос ресурсов процесса с периодом interval.
+
+    Prometheus при scrape только читает уже посчитанные gauge, сама выборка
+    (torch.cuda.*, /proc) происходит в отдельном потоке раз в interval секунд.
+    Если CUDA нет, вместо памяти GPU экспортируются RSS и CPU-время процесса.
+    generation_state - объект с полями active_sequences и kv_cache_bytes
+    (model.GENERATION_STATE), его обновляет цикл генерации.
+    """
+
+    def __init__(self, interval: float = TELEMETRY_INTERVAL_S, generation_state=None):
+        self.interval = interval
+        self.generation_state = generation_state
+        self.use_cuda = torch is not None and torch.cuda.is_available()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="resource-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def sample(self) -> None:
+        if self.generation_state is not None:
+            LLM_KV_CACHE_BYTES.set(self.generation_state.kv_cache_bytes)
+            LLM_ACTIVE_SEQUENCES.set(self.generation_state.active_sequences)
+        if self.use_cuda:
+            self._sample_cuda()
+        else:
+            self._sample_process()
+
+    def _sample_cuda(self) -> None:
+        for index in range(torch.cuda.device_count()):
+            device = str(index)
+            LLM_GPU_MEMORY_ALLOCATED.labels(device=device).set(torch.cuda.memory_allocated(index))
+            LLM_GPU_MEMORY_RESERVED.labels(device=device).set(torch.cuda.memory_reserved(index))
+            LLM_GPU_MEMORY_PEAK.labels(device=device).set(torch.cuda.max_memory_allocated(index))
+            free, total = torch.cuda.mem_get_info(index)
+            LLM_GPU_MEMORY_FREE.labels(device=device).set(free)
+            LLM_GPU_MEMORY_TOTAL.labels(device=device).set(total)
+            stats = torch.cuda.memory_stats(index)
+            LLM_GPU_ALLOC_RETRIES.labels(device=device).set(stats.get("num_alloc_retries", 0))
+            LLM_GPU_OOMS.labels(device=device).set(stats.get("num_ooms", 0))
+
+    def _sample_process(self) -> None:
+        rss = _read_rss_bytes()
+        if rss is not None:
+            LLM_PROCESS_RSS.set(rss)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        LLM_PROCESS_CPU_SECONDS.set(usage.ru_utime + usage.ru_stime)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error("TELEMETRY: sampling failed: %s", str(e))
+            self._stop.wait(max(self.interval - (time.monotonic() - started), 0.0))
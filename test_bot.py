@@ -51,7 +51,7 @@ print("ТЕСТ 3: Проверка функций model.py")
 print("=" * 60)
 
 try:
-    from model import build_llama3_prompt, clean_llama3_output
+    from prompts import build_llama3_prompt, clean_llama3_output
     
     # Тест 3a: build_llama3_prompt
     system = "Ты помощник"